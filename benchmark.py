@@ -0,0 +1,242 @@
+# Benchmarks for the hot paths of parse.py, run against the items in sampleItemsIG.txt and a fake trade API
+# (see fake_api.py), so no request ever reaches pathofexile.com:
+#
+#   python benchmark.py [items file] [--save results.json] [--compare results.json]
+#
+# Every stage is timed call by call and reported as percentiles. The price stage runs the whole price check
+# (query_trade/query_exchange, searches and fetches) with a cold search cache for every item, and also counts the
+# requests it took. --compare checks the results against a saved run and exits with status 1 on a regression.
+import argparse
+import contextlib
+import copy
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from colorama import Fore
+
+import fake_api
+import parse
+from parse import create_pseudo_mods, find_affix_match, parse_item_info, price_item, read_items
+
+# Bump this whenever the layout of the saved results changes, older results can't be compared with then.
+RESULTS_VERSION = 1
+# Percentiles reported for every stage.
+PERCENTILES = (50, 90, 99)
+
+
+def read_sample_items(path):
+	"""
+	Read a file of copied items, separated by blank lines.
+
+	returns list of item texts.
+	"""
+	with open(path, encoding="utf-8") as f:
+		return list(read_items(f))
+
+
+def time_calls(func, args, repeat, setup = None):
+	"""
+	Call func once per argument in args, repeat times over, after a round to warm up. setup(arg), if given, makes the
+	argument for every call outside of the timing, for functions that change their argument.
+
+	returns list of microseconds per call.
+	"""
+	# One round to warm up, and no garbage collection in the middle of a call, like timeit.
+	for arg in args:
+		func(setup(arg) if setup else arg)
+
+	samples = []
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		for _ in range(repeat):
+			for arg in args:
+				if setup:
+					arg = setup(arg)
+				start = time.perf_counter()
+				func(arg)
+				samples.append((time.perf_counter() - start) * 1e6)
+	finally:
+		if gc_was_enabled:
+			gc.enable()
+
+	return samples
+
+
+def percentile(samples, p):
+	"""
+	The p-th percentile of samples, by nearest rank.
+	"""
+	ordered = sorted(samples)
+	rank = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+	return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(samples):
+	"""
+	returns dictionary with the number of calls, the percentiles, mean and max in microseconds.
+	"""
+	summary = {'calls': len(samples)}
+	for p in PERCENTILES:
+		summary[f'p{p}_us'] = round(percentile(samples, p), 2)
+	summary['mean_us'] = round(sum(samples) / len(samples), 2)
+	summary['max_us'] = round(max(samples), 2)
+
+	return summary
+
+
+def peak_memory(func, args):
+	"""
+	Call func once per argument in args under tracemalloc.
+
+	returns the peak of memory allocated in KiB.
+	"""
+	tracemalloc.start()
+	try:
+		for arg in args:
+			func(arg)
+		return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+	finally:
+		tracemalloc.stop()
+
+
+def stat_query(item):
+	"""
+	The stats part of the query query_trade makes for item, which create_pseudo_mods works on.
+	"""
+	filters = []
+	for stat in item.stats:
+		(stat_id, values) = find_affix_match(stat)
+		if stat_id:
+			filters.append({'id': stat_id, 'value': {'min': parse.affix_value(values), 'max': 999}})
+
+	return {'query': {'stats': [{'type': 'and', 'filters': filters}]}}
+
+
+def price_cold(item):
+	"""
+	Price an item as if it was the first time, without the search cache.
+	"""
+	parse.search_cache.clear()
+	return price_item(item)
+
+
+def run(items, repeat, server):
+	"""
+	Benchmark every stage on the items.
+
+	returns dictionary of the results, as saved by --save.
+	"""
+	parsed = [item for item in map(parse_item_info, items) if item]
+	stats = [stat for item in parsed for stat in item.stats]
+	queries = [stat_query(item) for item in parsed if item.stats]
+	parse.load_stat_indexes()
+
+	stages = [
+		('parse', parse_item_info, items, repeat * 100, None),
+		('match', find_affix_match, stats, repeat * 100, None),
+		('pseudo', create_pseudo_mods, queries, repeat * 100, copy.deepcopy),
+		('price', price_cold, parsed, repeat, None),
+	]
+
+	results = {
+		'version': RESULTS_VERSION,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'items': len(items),
+		'stages': {},
+		'memory_kib': {},
+	}
+	for (name, func, args, number, setup) in stages:
+		results['stages'][name] = summarize(time_calls(func, args, number, setup))
+
+		# tracemalloc slows everything down, so memory is measured in a round of its own.
+		if setup:
+			args = [setup(arg) for arg in args]
+		before = sum(server.requests.values())
+		results['memory_kib'][name] = peak_memory(func, args)
+		if name == 'price':
+			results['requests_per_item'] = round((sum(server.requests.values()) - before) / len(args), 2)
+
+	return results
+
+
+def report(results):
+	print(f"[*] {results['items']} items, Python {results['python']}")
+	print(f"    {'stage':8}{'calls':>8}" + "".join(f"{f'p{p}':>12}" for p in PERCENTILES) + f"{'peak KiB':>12}")
+	for (name, summary) in results['stages'].items():
+		print(f"    {name:8}{summary['calls']:>8}" + "".join(f"{summary[f'p{p}_us']:>10.1f}us" for p in PERCENTILES)
+				+ f"{results['memory_kib'][name]:>12.1f}")
+	print(f"[*] {results['requests_per_item']} requests per priced item")
+
+
+def compare(results, previous, threshold):
+	"""
+	Print how results changed from a previous run. A stage's median or peak memory, or the requests per item, going up
+	by more than threshold percent is a regression.
+
+	returns list of the regressions.
+	"""
+	if previous.get('version') != RESULTS_VERSION:
+		print("[!] The previous results are from another version of the benchmark, not comparing.")
+		return []
+
+	changes = []
+	for (name, summary) in results['stages'].items():
+		if name in previous['stages']:
+			changes.append((f"{name} p50", previous['stages'][name]['p50_us'], summary['p50_us']))
+		if name in previous['memory_kib']:
+			changes.append((f"{name} memory", previous['memory_kib'][name], results['memory_kib'][name]))
+	changes.append(("requests per item", previous['requests_per_item'], results['requests_per_item']))
+
+	regressions = []
+	print("[*] Compared to the previous run:")
+	for (what, old, new) in changes:
+		change = (new - old) / old * 100 if old else 0
+		if change > threshold:
+			regressions.append(what)
+			print(f"    {what:24}{old:>12.2f} -> {new:>12.2f}  " + Fore.RED + f"{change:+.1f}%" + Fore.RESET)
+		else:
+			print(f"    {what:24}{old:>12.2f} -> {new:>12.2f}  {change:+.1f}%")
+
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the parse, match and price check stages.")
+	parser.add_argument('items', nargs='?', default="sampleItemsIG.txt", help="file of copied items")
+	parser.add_argument('--repeat', type=int, default=3, help="times to price every item (other stages 100x that)")
+	parser.add_argument('--latency', type=float, default=0, help="seconds the fake API adds to every response")
+	parser.add_argument('--rate-limits', action='store_true', help="have the fake API enforce the rate limits")
+	parser.add_argument('--save', metavar="FILE", help="write the results as JSON")
+	parser.add_argument('--compare', metavar="FILE", help="compare with results saved by an earlier run")
+	parser.add_argument('--threshold', type=float, default=20, help="percent worse that counts as a regression")
+	args = parser.parse_args()
+
+	server = fake_api.start(latency=args.latency, rate_limits=args.rate_limits)
+	parse.API_URL = server.url
+	parse.CACHE_DIR = tempfile.mkdtemp(prefix="poe-benchmark-")
+
+	items = read_sample_items(args.items)
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		results = run(items, args.repeat, server)
+	server.shutdown()
+	report(results)
+
+	if args.save:
+		with open(args.save, "w", encoding="utf-8") as f:
+			json.dump(results, f, indent='\t')
+		print(f"[+] Saved the results to {args.save}")
+
+	if args.compare:
+		with open(args.compare, encoding="utf-8") as f:
+			regressions = compare(results, json.load(f), args.threshold)
+		if regressions:
+			print(f"[!] Regressed: {', '.join(regressions)}")
+			sys.exit(1)
@@ -0,0 +1,153 @@
+# In-memory LRU cache with a time to live, used to remember trade searches and the listings fetched for them,
+# and a coalescer so identical searches that are running at the same time only go out once.
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def cache_key(*parts):
+	"""
+	Hash JSON-able parts (e.g. a league and a search query) into a key. Dict order doesn't matter, so two queries
+	built in a different order still share a key.
+
+	returns string
+	"""
+	canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+	return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class TTLCache:
+	"""
+	Keeps the maxsize most recently used items, each for at most ttl seconds. Safe to share between threads.
+	"""
+	def __init__(self, maxsize = 256, ttl = 300):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		# key -> (time it expires, value), least recently used first
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, key, default = None):
+		with self._lock:
+			item = self._items.get(key)
+			if item is None or item[0] <= time.time():
+				if item is not None:
+					del self._items[key]
+				self.misses += 1
+				return default
+
+			self._items.move_to_end(key)
+			self.hits += 1
+			return item[1]
+
+	def put(self, key, value):
+		with self._lock:
+			self._items[key] = (time.time() + self.ttl, value)
+			self._items.move_to_end(key)
+			while len(self._items) > self.maxsize:
+				self._items.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+	def stats(self):
+		"""
+		returns dictionary with the hit and miss counts and the number of cached items.
+		"""
+		with self._lock:
+			return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+	def save(self, path):
+		"""
+		Write the unexpired items to a JSON file. Keys and values have to be JSON-able.
+		"""
+		now = time.time()
+		with self._lock:
+			items = [[key, expires, value] for (key, (expires, value)) in self._items.items() if expires > now]
+
+		try:
+			os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+			with open(path + ".tmp", "w", encoding="utf-8") as f:
+				json.dump(items, f)
+			os.replace(path + ".tmp", path)
+		except OSError as e:
+			print(f"[!] Could not save the search cache: {e}")
+
+	def load(self, path):
+		"""
+		Read items written by save, skipping the ones that expired in the meantime.
+		"""
+		try:
+			with open(path, encoding="utf-8") as f:
+				items = json.load(f)
+		except (OSError, ValueError):
+			return
+
+		now = time.time()
+		with self._lock:
+			for (key, expires, value) in items:
+				if expires > now:
+					self._items[key] = (expires, value)
+			while len(self._items) > self.maxsize:
+				self._items.popitem(last=False)
+
+
+class Coalescer:
+	"""
+	Lets identical calls that run at the same time share one run. The first caller for a key does the work, callers
+	that come in while it's running wait for it and get the same result (or exception). Callers get the same
+	object, so they mustn't change it.
+	"""
+	def __init__(self):
+		self.shared = 0
+		# key -> Future of the running call
+		self._running = {}
+		self._lock = threading.Lock()
+
+	def run(self, key, func, *args, **kwargs):
+		with self._lock:
+			future = self._running.get(key)
+			owner = future is None
+			if owner:
+				future = self._running[key] = Future()
+			else:
+				self.shared += 1
+
+		if not owner:
+			return future.result()
+
+		try:
+			result = func(*args, **kwargs)
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		else:
+			future.set_result(result)
+			return result
+		finally:
+			with self._lock:
+				del self._running[key]
+
+	def coalesce(self, key):
+		"""
+		Decorator sharing concurrent calls of a function whose arguments give the same key(*args, **kwargs).
+		"""
+		def decorate(func):
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				return self.run((func.__name__, key(*args, **kwargs)), func, *args, **kwargs)
+
+			return wrapper
+
+		return decorate
@@ -0,0 +1,165 @@
+# Ways of noticing that something new was copied.
+#
+# The text itself is always read through Tk. What differs is how we find out the clipboard changed:
+#   X11Clipboard      - X11 with the XFixes extension tells us whenever the clipboard gets a new owner.
+#   WindowsClipboard  - Windows bumps a sequence number on every copy, which is free to check.
+#   PollingClipboard  - anything else, read the clipboard every so often and back off while nothing happens.
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from tkinter import TclError
+
+
+class PollingClipboard:
+	"""
+	Polls the clipboard text. Right after a change it polls every MIN_INTERVAL seconds, then slows down to
+	MAX_INTERVAL while the clipboard stays the same.
+	"""
+	MIN_INTERVAL = 0.05
+	MAX_INTERVAL = 0.3
+	BACKOFF = 1.5
+
+	def __init__(self, root):
+		self.root = root
+		self.interval = self.MIN_INTERVAL
+
+	def get_text(self):
+		"""
+		returns the clipboard text, or None if the clipboard doesn't hold text.
+		"""
+		try:
+			return self.root.clipboard_get()
+		except TclError:
+			return None
+
+	def wait(self):
+		"""
+		Block until the clipboard may have changed.
+		"""
+		time.sleep(self.interval)
+		self.interval = min(self.interval * self.BACKOFF, self.MAX_INTERVAL)
+
+	def changed(self):
+		"""
+		Tell the backend the text did change, so it reacts quickly to the next copy too.
+		"""
+		self.interval = self.MIN_INTERVAL
+
+	def close(self):
+		pass
+
+
+class WindowsClipboard(PollingClipboard):
+	"""
+	Checks GetClipboardSequenceNumber, and only reads the clipboard once it moved.
+	"""
+	INTERVAL = 0.05
+
+	def __init__(self, root):
+		super().__init__(root)
+		self.user32 = ctypes.windll.user32
+		self.sequence = None
+
+	def wait(self):
+		while True:
+			sequence = self.user32.GetClipboardSequenceNumber()
+			if sequence != self.sequence:
+				self.sequence = sequence
+				return
+			time.sleep(self.INTERVAL)
+
+	def changed(self):
+		pass
+
+
+class X11Clipboard(PollingClipboard):
+	"""
+	Sleeps on the X connection until XFixes reports a new owner of the CLIPBOARD selection.
+	"""
+	XFixesSetSelectionOwnerNotifyMask = 1
+	# Wake up this often even without events, so Ctrl+C in the terminal is handled.
+	TIMEOUT = 1.0
+
+	def __init__(self, root):
+		super().__init__(root)
+		self.xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+		self.xfixes = ctypes.CDLL(ctypes.util.find_library('Xfixes'))
+		self.xlib.XOpenDisplay.restype = ctypes.c_void_p
+		self.xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+		self.xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+		self.xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+		self.xlib.XInternAtom.restype = ctypes.c_ulong
+		self.xlib.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+		self.xlib.XConnectionNumber.argtypes = [ctypes.c_void_p]
+		self.xlib.XPending.argtypes = [ctypes.c_void_p]
+		self.xlib.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+		self.xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+		self.xfixes.XFixesQueryExtension.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+				ctypes.POINTER(ctypes.c_int)]
+		self.xfixes.XFixesSelectSelectionInput.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong,
+				ctypes.c_ulong]
+
+		self.display = self.xlib.XOpenDisplay(None)
+		if not self.display:
+			raise OSError("cannot open the X display")
+
+		event_base, error_base = ctypes.c_int(), ctypes.c_int()
+		if not self.xfixes.XFixesQueryExtension(self.display, ctypes.byref(event_base), ctypes.byref(error_base)):
+			self.xlib.XCloseDisplay(self.display)
+			raise OSError("the X server has no XFixes extension")
+
+		window = self.xlib.XDefaultRootWindow(self.display)
+		clipboard = self.xlib.XInternAtom(self.display, b"CLIPBOARD", False)
+		self.xfixes.XFixesSelectSelectionInput(self.display, window, clipboard, self.XFixesSetSelectionOwnerNotifyMask)
+		self.fd = self.xlib.XConnectionNumber(self.display)
+		# Big enough for any XEvent, we only care that one arrived.
+		self.event = ctypes.create_string_buffer(256)
+		# Whatever is on the clipboard at startup counts as new.
+		self.pending = True
+
+	def drain(self):
+		"""
+		Read all queued X events, returns whether there were any.
+		"""
+		got = False
+		while self.xlib.XPending(self.display):
+			self.xlib.XNextEvent(self.display, self.event)
+			got = True
+
+		return got
+
+	def wait(self):
+		if self.pending:
+			self.pending = False
+			return
+
+		while not self.drain():
+			select.select([self.fd], [], [], self.TIMEOUT)
+
+	def changed(self):
+		pass
+
+	def close(self):
+		if self.display:
+			self.xlib.XCloseDisplay(self.display)
+			self.display = None
+
+
+def open_clipboard(root):
+	"""
+	Pick the best way to watch the clipboard on this system, falling back to polling.
+	"""
+	if os.name == 'nt':
+		try:
+			return WindowsClipboard(root)
+		except (AttributeError, OSError):
+			pass
+	elif os.environ.get('DISPLAY') and ctypes.util.find_library('X11') and ctypes.util.find_library('Xfixes'):
+		try:
+			return X11Clipboard(root)
+		except OSError:
+			pass
+
+	return PollingClipboard(root)
@@ -1,6 +1,16 @@
 # Contains the following lookup dictionaries:
-# CURRENCY, OIL, CATALYSTS, FRAGMENTS_AND_SETS, INCUBATORS, SCARABS, RESONATORS
+# CURRENCY, OILS, CATALYSTS, FRAGMENTS_AND_SETS, INCUBATORS, SCARABS, RESONATORS
 # FOSSILS, VIALS, ESSENCES, DIV_CARDS
+# and CURRENCY_INDEX, all of them merged into one, looked up through find_currency.
+#
+# The tables written out here are the ones in use until gen_currency.py is run. That writes currency.json from the
+# trade site's static data, and every category it has a table for then uses that table instead (the names above are
+# pointed at it, so they always hold what find_currency sees). A fix made here only counts for the categories the
+# snapshot doesn't have.
+import json
+import os
+from types import MappingProxyType
+
 CURRENCY = {
 	"Orb of Alteration": "alt",
 	"Orb of Fusing": "fuse",
@@ -21,7 +31,7 @@ CURRENCY = {
 	"Vaal Orb": "vaal",
 	"Orb of Annulment": "orb-of-annulment",
 	"Orb of Binding": "orb-of-binding",
-	"Ancient Orb": "anient-orb",
+	"Ancient Orb": "ancient-orb",
 	"Orb of Horizons": "orb-of-horizons",
 	"Harbinger's Orb": "harbingers-orb",
 	"Scroll of Wisdom": "wis",
@@ -40,7 +50,7 @@ CURRENCY = {
 	"Exalted Shard": "exalted-shard",
 	"Binding Shard": "binding-shard",
 	"Horizon Shard": "horizon-shard",
-	"Harbinger's Shard": "harbinger's-shard",
+	"Harbinger's Shard": "harbingers-shard",
 	"Engineer's Shard": "engineers-shard",
 	"Ancient Shard": "ancient-shard",
 	"Chaos Shard": "chaos-shard",
@@ -64,7 +74,7 @@ CURRENCY = {
 	"Timeless Templar Splinter": "timeless-templar-splinter",
 	"Timeless Vaal Splinter": "timeless-vaal-splinter",
 	"Stacked Deck": "stacked-deck",
-	"Transumation Shard": "transmutation-shard",
+	"Transmutation Shard": "transmutation-shard",
 	"Alteration Shard": "alteration-shard",
 	"Alchemy Shard": "alchemy-shard"
 }
@@ -276,11 +286,11 @@ VIALS = {
 	"Vial of Consequence": "vial-of-consequence",
 	"Vial of the Ghost": "vial-of-the-ghost",
 	"Vial of Transcendence": "vial-of-transcendence",
-	"Vial of Sacrifice ": "vial-of-sacrifice-"
+	"Vial of Sacrifice": "vial-of-sacrifice"
 }
 	
 ESSENCES = {
-	"Whispering Essence of Hatred": " whispering-essence-of-hatred",
+	"Whispering Essence of Hatred": "whispering-essence-of-hatred",
 	"Muttering Essence of Hatred": "muttering-essence-of-hatred",
 	"Weeping Essence of Hatred": "weeping-essence-of-hatred",
 	"Wailing Essence of Hatred": "wailing-essence-of-hatred",
@@ -384,7 +394,7 @@ ESSENCES = {
 	"Essence of Insanity": "essence-of-insanity",
 	"Essence of Horror": "essence-of-horror",
 	"Essence of Delirium": "essence-of-delirium",
-	"Remnant of Corruption ": "remnant-of-corruption"
+	"Remnant of Corruption": "remnant-of-corruption"
 }
 
 DIV_CARDS = {
@@ -683,4 +693,85 @@ DIV_CARDS = {
 	"Void of the Elements":"void-of-the-elements",
 	"Volatile Power":"volatile-power",
 	"Wealth and Power":"wealth-and-power"
-}
\ No newline at end of file
+}
+
+
+# Generated tables, see gen_currency.py. A snapshot with another version is ignored.
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "currency.json")
+SNAPSHOT_VERSION = 1
+
+
+def load_snapshot(path = SNAPSHOT_PATH):
+	"""
+	Read the tables generated by gen_currency.py.
+
+	returns dictionary {category: {item name: trade id}}, or None if there's no usable snapshot.
+	"""
+	try:
+		with open(path, encoding="utf-8") as f:
+			snapshot = json.load(f)
+	except (OSError, ValueError):
+		return None
+
+	if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+		return None
+
+	tables = snapshot.get('tables')
+	return tables if isinstance(tables, dict) else None
+
+
+# Category name -> lookup dictionary in use, in the order they're merged into CURRENCY_INDEX. The snapshot replaces
+# the built in tables category by category.
+CATEGORIES = {
+	'currency': CURRENCY,
+	'oils': OILS,
+	'catalysts': CATALYSTS,
+	'fragments_and_sets': FRAGMENTS_AND_SETS,
+	'incubators': INCUBATORS,
+	'scarabs': SCARABS,
+	'resonators': RESONATORS,
+	'fossils': FOSSILS,
+	'vials': VIALS,
+	'essences': ESSENCES,
+	'div_cards': DIV_CARDS,
+}
+for (category, table) in (load_snapshot() or {}).items():
+	if category in CATEGORIES and isinstance(table, dict):
+		CATEGORIES[category] = table
+
+CURRENCY = CATEGORIES['currency']
+OILS = CATEGORIES['oils']
+CATALYSTS = CATEGORIES['catalysts']
+FRAGMENTS_AND_SETS = CATEGORIES['fragments_and_sets']
+INCUBATORS = CATEGORIES['incubators']
+SCARABS = CATEGORIES['scarabs']
+RESONATORS = CATEGORIES['resonators']
+FOSSILS = CATEGORIES['fossils']
+VIALS = CATEGORIES['vials']
+ESSENCES = CATEGORIES['essences']
+DIV_CARDS = CATEGORIES['div_cards']
+
+
+def normalize_name(name):
+	"""
+	Key an item name is filed under in CURRENCY_INDEX: lower case, with runs of whitespace collapsed to one space and
+	none at either end. "Vial of  Sacrifice " becomes "vial of sacrifice".
+
+	returns string
+	"""
+	return " ".join(name.split()).casefold()
+
+
+# normalize_name(item name) -> (category, trade id) for every dictionary above. Names in more than one dictionary
+# keep the last category they're in.
+CURRENCY_INDEX = MappingProxyType({normalize_name(name): (category, trade_id)
+		for (category, table) in CATEGORIES.items() for (name, trade_id) in table.items()})
+
+
+def find_currency(name):
+	"""
+	Look up a copied currency, fragment, scarab, ... or divination card by name.
+
+	returns tuple (category, trade id), or None if it isn't known
+	"""
+	return CURRENCY_INDEX.get(normalize_name(name))
@@ -0,0 +1,102 @@
+# Prices copied items in the background, so the clipboard keeps being watched while a price check runs.
+#
+# PricingEngine runs an asyncio event loop on a thread of its own and makes every copied item a task there. A new
+# item cancels the task of the one before: its price check stops at its next request or rate limit wait instead of
+# running to the end, and the new one starts right away. The price checks themselves are the blocking code of
+# parse.py, run in the loop's worker threads. Their independent requests (fetch pages, exchange probes) already go
+# out side by side through request_pool, under the shared rate limiter.
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+
+# A threading.Event that, once set, makes parse.api_request give up with LookupCancelled. Every price check gets
+# its own, and it's carried into request_pool along with the trace (see parse.submit).
+cancel_event = contextvars.ContextVar('cancel_event', default=None)
+
+
+class LookupCancelled(Exception):
+	"""
+	The price check a request was for got cancelled, because something else was copied in the meantime.
+	"""
+
+
+class PricingEngine:
+	"""
+	Runs price(item) (e.g. parse.show_prices) for every item given to submit, one item at a time, the latest one
+	winning.
+	"""
+	# Seconds close waits for the engine to wind down.
+	CLOSE_TIMEOUT = 2
+
+	def __init__(self, price):
+		self.price = price
+		self.loop = asyncio.new_event_loop()
+		# Task of the price check running now, if any. Only touched on the loop's thread.
+		self.current = None
+		self.thread = threading.Thread(target=self.loop.run_forever, name="pricing", daemon=True)
+		self.thread.start()
+
+	def submit(self, item):
+		"""
+		Price item, cancelling the price check of the item before if it's still running. Doesn't wait for anything,
+		so it's safe to call from the clipboard loop (or any other thread).
+		"""
+		self.loop.call_soon_threadsafe(self._start, item)
+
+	def _start(self, item):
+		if self.current is not None:
+			self.current.cancel()
+		self.current = self.loop.create_task(self._price(item))
+
+	async def _price(self, item):
+		cancel = threading.Event()
+		try:
+			while True:
+				# The cancel event goes with the price check into every thread it uses, see parse.submit.
+				context = contextvars.copy_context()
+				context.run(cancel_event.set, cancel)
+				try:
+					return await self.loop.run_in_executor(None, context.run, self._run, item, cancel)
+				except LookupCancelled:
+					if cancel.is_set():
+						return None
+					# It shared a search with an earlier price check that got cancelled, so run it again.
+		except asyncio.CancelledError:
+			cancel.set()
+			raise
+
+	def _run(self, item, cancel):
+		"""
+		Run price(item) on a worker thread, reporting the ways it can end instead of letting them kill the engine.
+		"""
+		try:
+			return self.price(item)
+		except LookupCancelled:
+			if cancel.is_set():
+				print(f"\n[-] Stopped pricing {item.name}.")
+			raise
+		except Exception as e:
+			print(f"\n[!] Pricing {item.name} failed: {e.__class__.__name__}: {e}")
+			return None
+
+	def close(self):
+		"""
+		Cancel the running price check and stop the engine. A request already on its way is left to finish.
+		"""
+		future = asyncio.run_coroutine_threadsafe(self._cancel(), self.loop)
+		try:
+			future.result(timeout=self.CLOSE_TIMEOUT)
+		except concurrent.futures.TimeoutError:
+			pass
+
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join(timeout=self.CLOSE_TIMEOUT)
+
+	async def _cancel(self):
+		if self.current is not None:
+			self.current.cancel()
+			try:
+				await self.current
+			except asyncio.CancelledError:
+				pass
@@ -0,0 +1,360 @@
+# A stand-in for the trade API, to measure and try out the request path without touching pathofexile.com:
+#   python fake_api.py [--port 8000] [--latency 0.05] [--reject-every 20]
+#   POE_API_URL=http://127.0.0.1:8000/api/trade python parse.py --batch sampleItemsIG.txt
+#
+# The data catalogs (/data/stats, /data/leagues, /data/static) are replayed from the fixtures directory, and so are
+# searches and fetches recorded there with --record. Any other search gets a made up but deterministic result with
+# fewer listings the more mods it asks for, so relaxing mods plays out like it does on the real site.
+# The catalogs in fixtures/data are made up as well: stats.json only has the mods of sampleItemsIG.txt, and
+# static.json was built from currency.py's tables, not taken from the trade site. Delete one and run with --record to
+# replace it with the real thing.
+# Responses carry rate limit headers like the real ones, and requests over the limit get a 429 with Retry-After.
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from cache import cache_key
+from ratelimit import parse_rule
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+API_PREFIX = "/api/trade/"
+REAL_API_URL = "https://www.pathofexile.com/api/trade"
+
+# Endpoint -> (policy name, Ip rule) like the trade site sends them, "hits:period:lockout" per window.
+RATE_LIMITS = {
+	'data': ('trade-data-request-limit', "30:10:60"),
+	'search': ('trade-search-request-limit', "5:5:10,15:60:300"),
+	'exchange': ('trade-exchange-request-limit', "5:5:10,15:60:300"),
+	'fetch': ('trade-fetch-request-limit', "12:4:10,16:12:300"),
+}
+
+# Listings a made up search finds before any mods are asked for. Every mod asked for halves it.
+BASE_TOTAL = 200
+# The trade site hands out at most this many result ids per search.
+MAX_RESULT_IDS = 100
+# Most ids one fetch may ask for.
+MAX_FETCH_IDS = 10
+
+
+class Policy:
+	"""
+	Server side of one rate limit policy: counts the hits in every window and locks clients out that go over.
+	"""
+	def __init__(self, name, rule):
+		self.name = name
+		self.rule = parse_rule(rule)
+		self.rule_text = rule
+		self.hits = deque()
+		self.blocked_until = 0
+		self.lock = threading.Lock()
+
+	def hit(self, now):
+		"""
+		Count a request, unless the client is (or now gets) locked out.
+
+		returns tuple (whether the request is allowed, seconds locked out)
+		"""
+		with self.lock:
+			longest = max(period for (_, period, _) in self.rule)
+			while self.hits and self.hits[0] <= now - longest:
+				self.hits.popleft()
+
+			if self.blocked_until > now:
+				return (False, self.blocked_until - now)
+
+			for (hits, period, lockout) in self.rule:
+				if sum(1 for t in self.hits if t > now - period) >= hits:
+					self.blocked_until = now + lockout
+					return (False, lockout)
+
+			self.hits.append(now)
+			return (True, 0)
+
+	def headers(self, now):
+		with self.lock:
+			active = max(self.blocked_until - now, 0)
+			state = ",".join(f"{sum(1 for t in self.hits if t > now - period)}:{period}:{int(active + 0.999)}"
+					for (_, period, _) in self.rule)
+
+		return {
+			'X-Rate-Limit-Policy': self.name,
+			'X-Rate-Limit-Rules': 'Ip',
+			'X-Rate-Limit-Ip': self.rule_text,
+			'X-Rate-Limit-Ip-State': state,
+		}
+
+
+def read_fixture(*parts):
+	"""
+	returns the bytes of a fixture file, or None if there's no such fixture.
+	"""
+	try:
+		with open(os.path.join(FIXTURES_DIR, *parts), "rb") as f:
+			return f.read()
+	except OSError:
+		return None
+
+
+def write_fixture(body, *parts):
+	path = os.path.join(FIXTURES_DIR, *parts)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "wb") as f:
+		f.write(body)
+
+
+def count_mods(query):
+	"""
+	How many mods a search asks for: every filter of an "and" group, plus the minimum of a "count" group.
+	"""
+	mods = 0
+	for group in query.get('query', {}).get('stats', []):
+		if group.get('type') == 'count':
+			mods += group.get('value', {}).get('min', 0)
+		elif group.get('type', 'and') == 'and':
+			mods += len(group.get('filters', []))
+
+	return mods
+
+
+def make_search(endpoint, league, query):
+	"""
+	Make up the result of a search. The query id comes from the query, so the same search gives the same result.
+
+	returns JSON of the search result.
+	"""
+	query_id = cache_key(endpoint, league, query)[:10]
+	total = BASE_TOTAL if endpoint == 'exchange' else BASE_TOTAL >> min(count_mods(query), 16)
+	ids = [f"{query_id}{i:04d}" for i in range(min(total, MAX_RESULT_IDS))]
+
+	return {'id': query_id, 'result': ids, 'total': total}
+
+
+def make_listing(result_id):
+	"""
+	Make up a listing for a result id handed out by make_search. Like on a real market, the first few listings are
+	cheaper and the rest sit at one price.
+	"""
+	position = int(result_id[-4:]) if result_id[-4:].isdigit() else 0
+
+	return {
+		'id': result_id,
+		'listing': {
+			'indexed': "2020-01-01T00:00:00Z",
+			'account': {'name': "fake_account", 'lastCharacterName': "FakeCharacter"},
+			'price': {'type': "~price", 'amount': 5 + min(position, 6) // 3, 'currency': "chaos"},
+		},
+		'item': {'id': result_id, 'verified': True, 'name': "", 'typeLine': "Fake Item"},
+	}
+
+
+class FakeTradeServer(ThreadingMixIn, HTTPServer):
+	"""
+	The fake trade API. latency is added to every response, every reject_every-th request is answered with a 429
+	no matter the rate limits (0 never does), rate_limits=False turns the rate limits off, and record_url is a
+	trade API to forward unrecorded requests to and record the answers from.
+	"""
+	daemon_threads = True
+
+	def __init__(self, address, latency = 0, reject_every = 0, rate_limits = True, record_url = None):
+		super().__init__(address, FakeTradeHandler)
+		self.latency = latency
+		self.reject_every = reject_every
+		self.record_url = record_url.rstrip('/') if record_url else None
+		self.policies = {endpoint: Policy(*limit) for (endpoint, limit) in RATE_LIMITS.items()} if rate_limits else {}
+		self.session = requests.Session() if record_url else None
+		self.lock = threading.Lock()
+		# endpoint -> requests answered, and how many of them got a 429.
+		self.requests = {}
+		self.rejected = 0
+
+	@property
+	def url(self):
+		"""
+		What to set POE_API_URL (or parse.API_URL) to.
+		"""
+		(host, port) = self.server_address[:2]
+		return f"http://{host}:{port}/api/trade"
+
+	def count(self, endpoint):
+		"""
+		Count a request to endpoint. returns whether it's one reject_every says to turn down.
+		"""
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+			total = sum(self.requests.values())
+
+		return bool(self.reject_every) and total % self.reject_every == 0
+
+	def forward(self, method, path, body, *fixture):
+		"""
+		Send a request on to record_url and record a successful answer as a fixture.
+
+		returns tuple (status code, body), or None when not recording.
+		"""
+		if not self.record_url:
+			return None
+
+		res = self.session.request(method, f"{self.record_url}/{path}", data=body,
+				headers={'Content-Type': 'application/json'} if body else {})
+		if res.status_code == 200:
+			write_fixture(res.content, *fixture)
+
+		return (res.status_code, res.content)
+
+
+class FakeTradeHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	# Headers and body go out in separate writes, which Nagle's algorithm would hold back for a delayed ACK.
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		self.handle_api('GET')
+
+	def do_POST(self):
+		self.handle_api('POST')
+
+	def log_message(self, format, *args):
+		pass
+
+	def handle_api(self, method):
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		url = urlsplit(self.path)
+		if not url.path.startswith(API_PREFIX):
+			return self.reply(404, {'error': {'code': 1, 'message': "Resource not found"}})
+
+		path = url.path[len(API_PREFIX):]
+		endpoint = path.split('/')[0]
+		if self.server.latency:
+			time.sleep(self.server.latency)
+
+		rejected = self.server.count(endpoint)
+		now = time.monotonic()
+		policy = self.server.policies.get(endpoint)
+		headers = {}
+		if policy:
+			(allowed, lockout) = policy.hit(now)
+			headers = policy.headers(now)
+			if not allowed:
+				rejected = True
+				headers['Retry-After'] = str(int(lockout + 0.999))
+		if rejected:
+			headers.setdefault('Retry-After', "1")
+			with self.server.lock:
+				self.server.rejected += 1
+			return self.reply(429, {'error': {'code': 3, 'message': "Rate limit exceeded"}}, headers)
+
+		if endpoint == 'data':
+			return self.reply_data(path, headers)
+		if endpoint in ('search', 'exchange') and method == 'POST':
+			return self.reply_search(endpoint, path, body, headers)
+		if endpoint == 'fetch' and method == 'GET':
+			return self.reply_fetch(path, url.query, headers)
+
+		self.reply(404, {'error': {'code': 1, 'message': "Resource not found"}}, headers)
+
+	def reply_data(self, path, headers):
+		name = path.split('/')[-1]
+		body = read_fixture("data", f"{name}.json")
+		if body is None:
+			recorded = self.server.forward('GET', path, None, "data", f"{name}.json")
+			if recorded is None:
+				return self.reply(404, {'error': {'code': 1, 'message': "Resource not found"}}, headers)
+			return self.reply(recorded[0], recorded[1], headers)
+
+		# Like the real site: catalogs can be revalidated with the ETag they were served with.
+		headers['ETag'] = '"' + hashlib.sha1(body).hexdigest() + '"'
+		if self.headers.get('If-None-Match') == headers['ETag']:
+			return self.reply(304, b"", headers)
+
+		self.reply(200, body, headers)
+
+	def reply_search(self, endpoint, path, body, headers):
+		league = path.split('/', 1)[1] if '/' in path else ""
+		try:
+			query = json.loads(body)
+		except ValueError:
+			return self.reply(400, {'error': {'code': 2, 'message': "Invalid query"}}, headers)
+
+		fixture = (endpoint, f"{cache_key(league, query)}.json")
+		recorded = read_fixture(*fixture)
+		if recorded is None:
+			recorded = self.server.forward('POST', path, body, *fixture)
+			if recorded is not None:
+				return self.reply(recorded[0], recorded[1], headers)
+			recorded = make_search(endpoint, league, query)
+
+		self.reply(200, recorded, headers)
+
+	def reply_fetch(self, path, query, headers):
+		ids = [i for i in path.split('/', 1)[1].split(',') if i] if '/' in path else []
+		if not ids or len(ids) > MAX_FETCH_IDS:
+			return self.reply(400, {'error': {'code': 2, 'message': "Invalid query"}}, headers)
+
+		params = parse_qs(query)
+		fixture = ("fetch", f"{cache_key(ids, params.get('query'), params.get('exchange'))}.json")
+		recorded = read_fixture(*fixture)
+		if recorded is None:
+			recorded = self.server.forward('GET', f"{path}?{query}", None, *fixture)
+			if recorded is not None:
+				return self.reply(recorded[0], recorded[1], headers)
+			recorded = {'result': [make_listing(i) for i in ids]}
+
+		self.reply(200, recorded, headers)
+
+	def reply(self, status, body, headers = {}):
+		if not isinstance(body, bytes):
+			body = json.dumps(body).encode('utf-8')
+
+		self.send_response(status)
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		if status != 304:
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if status != 304:
+			self.wfile.write(body)
+
+
+def start(host = "127.0.0.1", port = 0, **options):
+	"""
+	Run a fake trade API on a background thread. Port 0 picks a free port, see the server's url for which one.
+	The options are those of FakeTradeServer.
+
+	returns the FakeTradeServer, call its shutdown() to stop it.
+	"""
+	server = FakeTradeServer((host, port), **options)
+	threading.Thread(target=server.serve_forever, name="fake-api", daemon=True).start()
+
+	return server
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serve a fake trade API from the fixtures directory.")
+	parser.add_argument('--host', default="127.0.0.1")
+	parser.add_argument('--port', type=int, default=8000)
+	parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+	parser.add_argument('--reject-every', type=int, default=0, metavar="N", help="answer every Nth request with a 429")
+	parser.add_argument('--no-rate-limits', action='store_true', help="don't enforce the rate limits")
+	parser.add_argument('--record', nargs='?', const=REAL_API_URL, metavar="URL",
+			help=f"forward requests that have no fixture to URL (default {REAL_API_URL}) and record the answers")
+	args = parser.parse_args()
+
+	server = FakeTradeServer((args.host, args.port), latency=args.latency, reject_every=args.reject_every,
+			rate_limits=not args.no_rate_limits, record_url=args.record)
+	print(f"[*] Fake trade API at {server.url}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
@@ -0,0 +1,79 @@
+# Writes currency.json, a snapshot of currency.py's lookup tables made from the trade site's static data
+# (/api/trade/data/static). Run it after a league launch or patch that adds currency:
+#   python gen_currency.py [-o currency.json]
+import argparse
+import json
+import os
+import time
+
+from currency import SNAPSHOT_PATH, SNAPSHOT_VERSION
+from parse import API_URL, load_catalog
+
+# Static data category id -> the currency.py category it fills. Categories we don't price through the bulk
+# exchange (maps, leaguestones, ...) are left out.
+STATIC_CATEGORIES = {
+	'Currency': 'currency',
+	'Oils': 'oils',
+	'Catalysts': 'catalysts',
+	'Fragments': 'fragments_and_sets',
+	'Incubators': 'incubators',
+	'Scarabs': 'scarabs',
+	'DelveResonators': 'resonators',
+	'DelveFossils': 'fossils',
+	'Vials': 'vials',
+	'Essences': 'essences',
+	'Cards': 'div_cards',
+}
+
+
+def build_tables(static):
+	"""
+	Turn the static data catalog into currency.py's lookup tables.
+
+	returns dictionary {category: {item name: trade id}}
+	"""
+	tables = {}
+	for group in static['result']:
+		category = STATIC_CATEGORIES.get(group['id'])
+		if category is None:
+			print(f"[-] Skipping the {group['id']} category.")
+			continue
+
+		table = tables.setdefault(category, {})
+		for entry in group['entries']:
+			# Some entries only have an image, there's nothing to copy from the game for those.
+			if entry.get('text'):
+				table[entry['text'].strip()] = entry['id'].strip()
+
+	return tables
+
+
+def write_snapshot(tables, path, source):
+	"""
+	Write the tables as a compact snapshot currency.py can load, through a temp file.
+	"""
+	snapshot = {
+		'version': SNAPSHOT_VERSION,
+		'generated': int(time.time()),
+		'source': source,
+		'tables': tables,
+	}
+
+	with open(path + ".tmp", "w", encoding="utf-8") as f:
+		json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+	os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Regenerate the currency lookup tables from the trade site.")
+	parser.add_argument('-o', '--output', default=SNAPSHOT_PATH, help="where to write the snapshot")
+	args = parser.parse_args()
+
+	tables = build_tables(load_catalog('static', ttl=0))
+	write_snapshot(tables, args.output, f"{API_URL}/data/static")
+
+	missing = set(STATIC_CATEGORIES.values()) - set(tables)
+	if missing:
+		print(f"[!] The static data had nothing for {', '.join(sorted(missing))}, the built in tables stay in use.")
+
+	print(f"[+] Wrote {sum(len(t) for t in tables.values())} names in {len(tables)} categories to {args.output}.")
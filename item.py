@@ -0,0 +1,83 @@
+# What parse_item_info makes of a copied item.
+import sys
+from enum import Enum, IntFlag
+
+
+class Rarity(Enum):
+	NORMAL = "Normal"
+	MAGIC = "Magic"
+	RARE = "Rare"
+	UNIQUE = "Unique"
+	GEM = "Gem"
+	CURRENCY = "Currency"
+	DIVINATION_CARD = "Divination Card"
+
+
+class Kind(Enum):
+	"""
+	How an item gets priced. Currency (scarabs included) and divination cards go through the bulk exchange by name,
+	uniques by name, unidentified items and metamorph organs by base type and item level, gems by gem name, and
+	everything else (rare, magic and normal items) by base type and mods.
+	"""
+	CURRENCY = "Currency"
+	DIVINATION_CARD = "Divination Card"
+	UNIQUE = "Unique"
+	UNIDENTIFIED = "Unidentified"
+	METAMORPH = "Metamorph"
+	GEM = "Gem"
+	ITEM = "Item"
+
+
+class Influence(IntFlag):
+	NONE = 0
+	SHAPER = 1
+	ELDER = 2
+	CRUSADER = 4
+	HUNTER = 8
+	REDEEMER = 16
+	WARLORD = 32
+
+
+class ParsedItem:
+	"""
+	A copied item. Treat it as read only: it's hashed and compared by value, so equal items can share a price check.
+
+	itype is the type to search for: the base type, or the name for gems and unidentified items. stats is a tuple of
+	the mod lines as copied, implicits first.
+	"""
+	__slots__ = ('name', 'rarity', 'kind', 'itype', 'ilvl', 'quality', 'links', 'corrupted', 'influence', 'stats')
+
+	def __init__(self, name, rarity, kind, itype = None, ilvl = None, quality = 0, links = None, corrupted = False,
+			influence = Influence.NONE, stats = ()):
+		self.name = sys.intern(name)
+		self.rarity = rarity
+		self.kind = kind
+		self.itype = sys.intern(itype) if itype is not None else None
+		self.ilvl = ilvl
+		self.quality = quality
+		self.links = links
+		self.corrupted = corrupted
+		self.influence = influence
+		self.stats = tuple(stats)
+
+	def _key(self):
+		return (self.name, self.rarity, self.kind, self.itype, self.ilvl, self.quality, self.links, self.corrupted,
+				self.influence, self.stats)
+
+	def __eq__(self, other):
+		if not isinstance(other, ParsedItem):
+			return NotImplemented
+		return self._key() == other._key()
+
+	def __hash__(self):
+		return hash(self._key())
+
+	def __repr__(self):
+		return f"ParsedItem({self.name!r}, {self.rarity.value}, {self.kind.value}, itype={self.itype!r})"
+
+	@property
+	def influences(self):
+		"""
+		Names of the influences on the item, e.g. ["shaper", "warlord"].
+		"""
+		return [flag.name.lower() for flag in Influence if flag and flag in self.influence]
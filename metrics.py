@@ -0,0 +1,237 @@
+# Where the time of a price check goes.
+#
+# Spans time the stages of a price check (parsing, matching mods, searches, fetches, relaxing mods) and counters add
+# up things like requests, bytes and rate limit waits, while gauges hold the latest value of something (like how
+# much of a rate limit is left). Metrics keeps the totals, which can be dumped in the Prometheus text format. A price check run inside trace() also gets its own record of every span and counter, in
+# the order they happened, which is how to see where a slow one spent its time.
+#
+# The current trace is a context variable, so it follows a price check into other threads as long as the work is
+# submitted with contextvars.copy_context().run.
+import contextvars
+import functools
+import json
+import threading
+import time
+
+_trace = contextvars.ContextVar('trace', default=None)
+_depth = contextvars.ContextVar('depth', default=0)
+
+
+class Trace:
+	"""
+	What happened during one price check: every span (name, labels, start and duration in seconds from the start of
+	the trace, nesting depth) and every counter that went up. Recording starts when its with block is entered,
+	see Metrics.trace.
+	"""
+	def __init__(self, name):
+		self.name = name
+		self.start = time.perf_counter()
+		self.duration = None
+		self.spans = []
+		self.counters = {}
+		self._lock = threading.Lock()
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		self._token = _trace.set(self)
+		return self
+
+	def __exit__(self, *exc):
+		self.duration = time.perf_counter() - self.start
+		_trace.reset(self._token)
+
+	def add_span(self, name, labels, start, duration, depth):
+		with self._lock:
+			self.spans.append((name, labels, start - self.start, duration, depth))
+
+	def add(self, key, value):
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def to_dict(self):
+		"""
+		returns dictionary with the trace, JSON-able.
+		"""
+		with self._lock:
+			spans = sorted(self.spans, key=lambda span: span[2])
+			counters = sorted(self.counters.items())
+
+		return {
+			'name': self.name,
+			'seconds': round(self.duration or 0, 6),
+			'spans': [dict(name=name, start=round(start, 6), seconds=round(duration, 6), depth=depth, **dict(labels))
+					for (name, labels, start, duration, depth) in spans],
+			'counters': [dict(name=name, value=value, **dict(labels)) for ((name, labels), value) in counters],
+		}
+
+	def to_json(self):
+		return json.dumps(self.to_dict())
+
+	def format(self):
+		"""
+		The spans as an indented timeline, one per line.
+
+		returns string
+		"""
+		lines = [f"{self.name}: {(self.duration or 0) * 1000:.1f}ms"]
+		for span in self.to_dict()['spans']:
+			labels = " ".join(f"{k}={v}" for (k, v) in span.items() if k not in ('name', 'start', 'seconds', 'depth'))
+			lines.append(f"{span['start'] * 1000:9.1f}ms {'  ' * span['depth']}{span['name']} "
+					f"{span['seconds'] * 1000:.1f}ms {labels}".rstrip())
+
+		return "\n".join(lines)
+
+
+class Span:
+	"""
+	Times a with block. Made by Metrics.span, see there.
+	"""
+	__slots__ = ('metrics', 'name', 'labels', 'start', 'token')
+
+	def __init__(self, metrics, name, labels):
+		self.metrics = metrics
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.token = _depth.set(_depth.get() + 1)
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		duration = time.perf_counter() - self.start
+		_depth.reset(self.token)
+		self.metrics.observe(self.name, self.labels, duration)
+
+		trace = _trace.get()
+		if trace is not None:
+			trace.add_span(self.name, self.labels, self.start, duration, _depth.get())
+
+
+class Metrics:
+	"""
+	Counters and span timings, summed up over everything that ran since this was made. Safe to share between
+	threads.
+	"""
+	def __init__(self, prefix = "poe"):
+		self.prefix = prefix
+		self._lock = threading.Lock()
+		# (name, labels) -> value, labels being a sorted tuple of (label, value)
+		self._counters = {}
+		# (span name, labels) -> [times run, total seconds]
+		self._spans = {}
+		# (name, labels) -> latest value
+		self._gauges = {}
+
+	def span(self, name, **labels):
+		"""
+		Time a with block as a span called name, e.g. with metrics.span('search', endpoint='exchange'): ...
+		"""
+		return Span(self, name, tuple(sorted(labels.items())))
+
+	def timed(self, name):
+		"""
+		Decorator running every call of a function in a span.
+		"""
+		def decorate(func):
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				with Span(self, name, ()):
+					return func(*args, **kwargs)
+
+			return wrapper
+
+		return decorate
+
+	def observe(self, name, labels, seconds):
+		key = (name, labels)
+		with self._lock:
+			span = self._spans.get(key)
+			if span is None:
+				span = self._spans[key] = [0, 0.0]
+			span[0] += 1
+			span[1] += seconds
+
+	def add(self, name, value = 1, **labels):
+		"""
+		Add value to the counter called name with these labels, e.g. metrics.add('requests', endpoint='fetch').
+		"""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+		trace = _trace.get()
+		if trace is not None:
+			trace.add(key, value)
+
+	def gauge(self, name, value, **labels):
+		"""
+		Set the gauge called name with these labels to value, e.g. metrics.gauge('rate_limit_remaining', 3, policy=...).
+		"""
+		with self._lock:
+			self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+	def counter(self, name, **labels):
+		"""
+		returns the value of a counter, 0 if it never went up.
+		"""
+		with self._lock:
+			return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+	def trace(self, name):
+		"""
+		Record every span and counter of a with block (and of the work it submits to other threads) in a Trace,
+		which the with statement gives.
+		"""
+		return Trace(name)
+
+	def prometheus(self):
+		"""
+		Dump everything in the Prometheus text format. Counters become <prefix>_<name>_total, gauges <prefix>_<name>,
+		spans become a <prefix>_span_seconds summary labelled with the span's name.
+
+		returns string
+		"""
+		with self._lock:
+			counters = sorted(self._counters.items())
+			gauges = sorted(self._gauges.items())
+			spans = sorted(self._spans.items())
+
+		lines = []
+		seen = set()
+		for ((name, labels), value) in counters:
+			metric = f"{self.prefix}_{name}_total"
+			if metric not in seen:
+				seen.add(metric)
+				lines.append(f"# TYPE {metric} counter")
+			lines.append(f"{metric}{format_labels(labels)} {value}")
+
+		for ((name, labels), value) in gauges:
+			metric = f"{self.prefix}_{name}"
+			if metric not in seen:
+				seen.add(metric)
+				lines.append(f"# TYPE {metric} gauge")
+			lines.append(f"{metric}{format_labels(labels)} {value}")
+
+		if spans:
+			metric = f"{self.prefix}_span_seconds"
+			lines.append(f"# TYPE {metric} summary")
+			for ((name, labels), (count, seconds)) in spans:
+				labels = format_labels((('span', name),) + labels)
+				lines.append(f"{metric}_count{labels} {count}")
+				lines.append(f"{metric}_sum{labels} {seconds:.6f}")
+
+		return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+	"""
+	Format labels for the Prometheus text format: {endpoint="fetch",status="200"}, or nothing without labels.
+	"""
+	if not labels:
+		return ""
+
+	def escape(value):
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	return "{" + ",".join(f'{k}="{escape(v)}"' for (k, v) in labels) + "}"
@@ -1,282 +1,916 @@
+import argparse
+import contextlib
+import contextvars
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from tkinter import Tk, TclError
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import Tk
 import re
+import sys
+import threading
 import time
 from colorama import init, deinit, Fore, Back, Style
-from currency import (CURRENCY, OILS, CATALYSTS, FRAGMENTS_AND_SETS, INCUBATORS, SCARABS, RESONATORS,
-						FOSSILS, VIALS, ESSENCES, DIV_CARDS)
+from cache import Coalescer, TTLCache, cache_key
+from clipboard import open_clipboard
+from engine import LookupCancelled, PricingEngine, cancel_event
+from item import Influence, Kind, ParsedItem, Rarity
+from metrics import Metrics
+from ratelimit import RateLimiter
+from currency import find_currency
+
+# Where the trade API is. Point POE_API_URL at fake_api.py to work without touching pathofexile.com.
+API_URL = os.environ.get("POE_API_URL", "https://www.pathofexile.com/api/trade").rstrip("/")
+
+# The data catalogs (stats, leagues) are big and rarely change, so keep a copy of them on disk.
+CACHE_DIR = os.environ.get("POE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".path-of-accounting"))
+# Bump this whenever the layout of the cache files changes, old files are then ignored.
+CACHE_VERSION = 1
+# Seconds a cached catalog is used before asking the trade site whether it changed.
+CACHE_TTL = int(os.environ.get("POE_CACHE_TTL", 24 * 60 * 60))
+# Seconds to wait on the trade site before falling back to the cached catalog.
+CATALOG_TIMEOUT = 10
+
+# Requests made side by side (fetch pages, exchange searches) go through this pool. Small, since the API is rate limited.
+REQUEST_WORKERS = 4
+request_pool = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="request")
+# Items priced at the same time in batch mode. Their requests still wait on the rate limiter.
+BATCH_WORKERS = 4
+# Items read ahead in batch mode, per worker, while the ones before are being priced.
+BATCH_AHEAD = 2
+# Most connections kept open to the trade site. Enough for every request worker plus a few searches.
+POOL_SIZE = REQUEST_WORKERS + 4
+
+# Request counts, bytes, rate limit waits and how long every stage of a price check takes, see metrics.py.
+metrics = Metrics()
+# Where --trace writes the trace of every price check, None when not tracing.
+trace_file = None
+_trace_lock = threading.Lock()
+
+
+def submit(func, *args):
+	"""
+	Run func(*args) on request_pool, as part of the caller's trace and price check (see engine.py).
+
+	returns a Future.
+	"""
+	return request_pool.submit(contextvars.copy_context().run, func, *args)
+
+
+def make_session():
+	"""
+	Make the session every trade API call goes through. Connections are kept alive and reused, so a price check
+	only pays for the TCP+TLS handshake once.
+	"""
+	s = requests.Session()
+	s.headers.update({
+		'User-Agent': 'Path-of-Accounting (https://github.com/byi649/Path-of-Accounting)',
+		'Accept-Encoding': 'gzip, deflate',
+		'Connection': 'keep-alive',
+	})
+
+	# All our requests go to one host. pool_block makes extra threads wait for a free connection rather than
+	# opening more than POOL_SIZE of them.
+	adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, pool_block=True)
+	s.mount('https://', adapter)
+	s.mount('http://', adapter)
+
+	return s
+
+
+session = make_session()
+limiter = RateLimiter()
+# Times a rate limited (HTTP 429) request is retried, after waiting out the lockout.
+RATE_LIMIT_RETRIES = 3
+
+
+def api_request(method, path, retries = RATE_LIMIT_RETRIES, **kwargs):
+	"""
+	Send a request to the trade API, path being relative to API_URL (e.g. "search/Metamorph").
+	The request waits until it fits in the API's rate limits instead of running into them, and if it gets rate
+	limited anyway it waits out the lockout and tries again. Raises LookupCancelled once the price check's
+	cancel_event (see engine.py) is set, before the request is sent or before its response is used.
+
+	returns the response.
+	"""
+	endpoint = path.split('/')[0]
+	cancel = cancel_event.get()
+	for attempt in range(retries + 1):
+		if cancel is not None and cancel.is_set():
+			raise LookupCancelled()
+		waited = limiter.acquire(endpoint, cancel)
+		if waited is None:
+			raise LookupCancelled()
+		if waited:
+			metrics.add('rate_limit_waits', endpoint=endpoint)
+			metrics.add('rate_limit_wait_seconds', waited, endpoint=endpoint)
+		if waited >= 1:
+			print(f"[*] Waited {waited:.1f}s for the trade site's rate limit.")
+
+		try:
+			with metrics.span('request', endpoint=endpoint):
+				res = session.request(method, f"{API_URL}/{path}", **kwargs)
+		except requests.RequestException:
+			limiter.release(endpoint)
+			metrics.add('request_errors', endpoint=endpoint)
+			raise
+
+		metrics.add('requests', endpoint=endpoint, status=res.status_code)
+		metrics.add('request_bytes', len(res.request.body or b""), endpoint=endpoint)
+		metrics.add('response_bytes', len(res.content), endpoint=endpoint)
+		limiter.update(endpoint, res.headers, res.status_code)
+		if cancel is not None and cancel.is_set():
+			raise LookupCancelled()
+		if res.status_code != 429:
+			break
+
+		metrics.add('rate_limited', endpoint=endpoint)
+		if attempt < retries:
+			print(f"[!] Rate limited by the trade site, retrying in {limiter.delay(endpoint):.0f}s.")
+
+	return res
+
+
+def read_cache(name):
+	"""
+	Read a cached catalog from disk.
+
+	returns dictionary with the catalog and its metadata, or None if there's no usable cache.
+	"""
+	try:
+		with open(os.path.join(CACHE_DIR, f"{name}.json"), encoding="utf-8") as f:
+			cached = json.load(f)
+	except (OSError, ValueError):
+		return None
+
+	if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+		return None
+
+	# A catalog from another trade API (see POE_API_URL) isn't ours to use.
+	if cached.get('url', API_URL) != API_URL:
+		return None
+
+	return cached
+
+
+def write_cache(name, cached):
+	"""
+	Write a catalog to disk. Written to a temp file first so a crash never leaves a half written cache behind.
+	"""
+	path = os.path.join(CACHE_DIR, f"{name}.json")
+	try:
+		os.makedirs(CACHE_DIR, exist_ok=True)
+		with open(path + ".tmp", "w", encoding="utf-8") as f:
+			json.dump(cached, f)
+		os.replace(path + ".tmp", path)
+	except OSError as e:
+		print(f"[!] Could not write the {name} cache: {e}")
+
+
+def load_catalog(name, ttl=CACHE_TTL):
+	"""
+	Get one of the trade site's data catalogs (/api/trade/data/<name>), going through the on-disk cache.
+
+	A cache younger than ttl seconds is used without touching the network. An older one is revalidated with
+	ETag/Last-Modified, and is used anyway if the trade site is slow or unreachable.
+
+	returns JSON of the catalog.
+	"""
+	cached = read_cache(name)
+
+	if cached and time.time() - cached['fetched'] < ttl:
+		return cached['data']
+
+	headers = {}
+	if cached and cached.get('etag'):
+		headers['If-None-Match'] = cached['etag']
+	if cached and cached.get('last_modified'):
+		headers['If-Modified-Since'] = cached['last_modified']
+
+	try:
+		res = api_request('GET', f"data/{name}", retries=0, headers=headers, timeout=CATALOG_TIMEOUT)
+	except requests.RequestException as e:
+		if not cached:
+			raise
+		print(f"[!] Could not reach the trade site ({e.__class__.__name__}), using the cached {name} list.")
+		return cached['data']
+
+	if res.status_code == 304 and cached: # Not modified, our copy is still good.
+		cached['fetched'] = time.time()
+		write_cache(name, cached)
+		return cached['data']
+
+	if res.status_code != 200 and cached:
+		print(f"[!] Retrieving the {name} list failed: HTTP {res.status_code}! Using the cached {name} list.")
+		return cached['data']
+
+	res.raise_for_status()
+	data = res.json()
+	write_cache(name, {
+		'version': CACHE_VERSION,
+		'url': API_URL,
+		'fetched': time.time(),
+		'etag': res.headers.get('ETag'),
+		'last_modified': res.headers.get('Last-Modified'),
+		'data': data,
+	})
+
+	return data
+
+
+# Searches and fetched listings, so checking the same item again doesn't cost any requests.
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = int(os.environ.get("POE_SEARCH_CACHE_TTL", 5 * 60))
+# Set POE_PERSIST_SEARCHES=1 to keep the search cache between runs.
+PERSIST_SEARCHES = os.environ.get("POE_PERSIST_SEARCHES") == "1"
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+# Identical searches, fetches and price checks that run at the same time (in batch mode, say) share one run.
+inflight = Coalescer()
+
+# Catalogs loaded so far, by name. Filled lazily by get_catalog so importing this module is free.
+# "leagues" is the current leagues (not used), "stats" is all available stats on items.
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(name):
+	"""
+	Get a data catalog, loading it on first use. If it is still being loaded (see prefetch) this waits for it.
+
+	returns JSON of the catalog.
+	"""
+	if name not in _catalogs:
+		with _catalogs_lock:
+			if name not in _catalogs:
+				_catalogs[name] = load_catalog(name)
+
+	return _catalogs[name]
+
+
+def prefetch(*getters):
+	"""
+	Run getters (e.g. load_stat_indexes) on a background thread, so whatever needs what they load
+	later doesn't have to wait for it.
+	"""
+	def run():
+		for getter in getters:
+			try:
+				getter()
+			except (requests.RequestException, ValueError) as e:
+				# Whoever calls the getter next will retry and see the error.
+				print(f"[!] Could not load the trade data in the background: {e}")
+				break
+
+	threading.Thread(target=run, name="prefetch", daemon=True).start()
+
+
+# Where each kind of stat is in the stats catalog.
+STAT_GROUPS = {
+	'pseudo': 0,
+	'explicit': 1,
+	'implicit': 2,
+	'crafted': 5,
+}
+
+# Mods that are the last to be relaxed when searching for an item finds nothing.
+PRIORITY_MODS = {
+	'pseudo.pseudo_total_elemental_resistance',
+	'pseudo.pseudo_total_chaos_resistance',
+	'pseudo.pseudo_total_life',
+}
+
+# A number in a copied mod: "+91", "-10", "2.5", but not the "-33" in "20-33".
+AFFIX_NUMBER = re.compile(r"(?<![\w.])[+-]?\d+(?:\.\d+)?")
+
+# Built from the stats catalog the first time one of them is needed, see load_stat_indexes.
+_affix_index = None
+_stat_texts = None
+_index_lock = threading.Lock()
+
+
+def build_affix_index(stats):
+	"""
+	Index the stats catalog by the template a copied mod turns into (see affix_template), for each kind of stat.
+	Local stats are filed without the " (Local)" since copied mods don't say they're local. When two stats share a
+	template the later one wins.
+
+	returns dictionary {kind: {template: (id, text)}}
+	"""
+	index = {}
+	for kind, group in STAT_GROUPS.items():
+		templates = index[kind] = {}
+		for entry in stats['result'][group]['entries']:
+			text = entry['text']
+			if text.endswith(" (Local)"):
+				text = text[:-len(" (Local)")]
+			templates[text] = (entry['id'], entry['text'])
+
+	return index
+
+
+def build_stat_text_index(stats):
+	"""
+	Index every stat in the stats catalog by its id.
+
+	returns dictionary {id: text}
+	"""
+	return {entry['id']: entry['text'] for group in stats['result'] for entry in group['entries']}
 
-# Current Leagues. Not used.
-leagues = requests.get(url="https://www.pathofexile.com/api/trade/data/leagues").json()
-# All available stats on items.
-stats = requests.get(url="https://www.pathofexile.com/api/trade/data/stats").json()
 
-# This is here so we don't remake it everytime we need it.
-IG_CURRENCY = [CURRENCY, OILS, CATALYSTS, FRAGMENTS_AND_SETS, INCUBATORS, SCARABS, RESONATORS,
-				FOSSILS, VIALS, ESSENCES, DIV_CARDS]
+def load_stat_indexes():
+	"""
+	Build the stat indexes (and load the stats catalog) if that hasn't happened yet.
+	"""
+	global _affix_index, _stat_texts
+	if _affix_index is None:
+		stats = get_catalog("stats")
+		with _index_lock:
+			if _affix_index is None:
+				_stat_texts = build_stat_text_index(stats)
+				# Set last, it's what tells other threads the indexes are ready.
+				_affix_index = build_affix_index(stats)
+
+
+def get_affix_index():
+	"""
+	Get the affix index, see build_affix_index.
+	"""
+	load_stat_indexes()
+	return _affix_index
 
 
+def get_stat_text(stat_id):
+	"""
+	Look up the text of a stat by its id, e.g. "explicit.stat_3299347043" -> "# to maximum Life".
+
+	returns string, or None if there's no such stat.
+	"""
+	load_stat_indexes()
+	return _stat_texts.get(stat_id)
+
+
+# Separates the sections of a copied item.
+SEPARATOR = "--------"
+
+# Lines that mark an item as influenced, and the influence they stand for.
+INFLUENCE_LINES = {
+	'Shaper Item': Influence.SHAPER,
+	'Elder Item': Influence.ELDER,
+	'Crusader Item': Influence.CRUSADER,
+	'Hunter Item': Influence.HUNTER,
+	'Redeemer Item': Influence.REDEEMER,
+	'Warlord Item': Influence.WARLORD,
+}
+
+# Start of the lines with properties parse_item_info reads ("Item Level: ", "Quality: ", "Sockets: "),
+# so it can skip all other lines with one set lookup.
+PROPERTY_PREFIXES = {"Item", "Qual", "Sock"}
+
+# Sections with any of these lines hold item properties, not mods.
+MARKER_LINES = {"Corrupted", "Unidentified", "Mirrored", "Split", *INFLUENCE_LINES}
+
+
+def split_sections(text):
+	"""
+	Split copied item text into its sections (what's between the "--------" lines).
+
+	returns list of sections, each a list of its non-empty lines.
+	"""
+	sections = [[]]
+	section = sections[0]
+	for line in text.splitlines():
+		if line == SEPARATOR:
+			section = []
+			sections.append(section)
+		elif line:
+			section.append(line)
+
+	return sections
+
+
+def count_links(sockets):
+	"""
+	Count the biggest group of linked sockets, e.g. "B-B-G R-B" has 3 links.
+
+	returns int, or None if there are no sockets listed.
+	"""
+	return max((group.count('-') + 1 for group in sockets.split()), default=None)
+
+
+def parse_number(text):
+	"""
+	Read the number of a property like "Item Level: 84" or "Quality: +20% (augmented)", text being what's after the
+	property's name.
+
+	returns int, or None if the text doesn't start with one (a line cut short or edited by hand).
+	"""
+	match = re.match(r'[+-]?\d+', text)
+	return int(match.group()) if match else None
+
+
+@metrics.timed('parse')
 def parse_item_info(text):
 	"""
 	Parse item info (from clipboard, as obtained by pressing Ctrl+C hovering an item in-game).
+	The text is read in one walk over its sections.
+
+	returns ParsedItem, or None if the text isn't an item.
 	"""
+	sections = split_sections(text)
+	header = sections[0]
+
 	# Find out if this is a path of exile item
-	m = re.findall(r'^Rarity: (\w+)\r?\n(.+?)\r?\n(.+?)\r?\n', text)
+	if not text.startswith("Rarity: ") or len(header) < 2: # It's not...
+		return None
+
+	try:
+		rarity = Rarity(header[0][len("Rarity: "):])
+	except ValueError: # Quest items and such, nothing to price.
+		return None
+
+	# get some basic info. Items without a base type line (currency, magic items...) get sorted out below.
+	name = header[1]
+	itype = header[2] if len(header) > 2 else None
+
+	unidentified = corrupted = False
+	influence = Influence.NONE
+	quality = 0
+	ilvl = links = mods_from = None
+
+	for (index, section) in enumerate(sections):
+		# Properties come before the item level, after it there's only mods and markers like "Corrupted".
+		check_properties = mods_from is None
+		for line in section:
+			if line in MARKER_LINES:
+				if line == "Corrupted":
+					corrupted = True
+				elif line == "Unidentified":
+					unidentified = True
+				elif line in INFLUENCE_LINES:
+					influence |= INFLUENCE_LINES[line]
+			elif not check_properties or line[:4] not in PROPERTY_PREFIXES:
+				continue
+			elif line.startswith("Item Level: "):
+				ilvl = parse_number(line[len("Item Level: "):])
+				mods_from = index + 1
+			elif line.startswith("Quality: ") and not quality:
+				quality = parse_number(line[len("Quality: "):]) or 0
+			elif line.startswith("Sockets: "):
+				links = count_links(line[len("Sockets: "):])
 
-	if not m: # It's not...
-		m = re.findall(r"^Rarity: (.*)\n(.*)", text)
-		if not m:
-			return {}
+	# Oh, it's currency!
+	if rarity == Rarity.CURRENCY or (rarity == Rarity.NORMAL and 'Scarab' in name):
+		return ParsedItem(name, rarity, Kind.CURRENCY, "Currency")
+	elif rarity == Rarity.DIVINATION_CARD:
+		return ParsedItem(name, rarity, Kind.DIVINATION_CARD, "Divination Card")
+	elif itype is None and unidentified: #Unided
+		return ParsedItem(name, rarity, Kind.UNIDENTIFIED, name, ilvl=ilvl)
+	elif "Tane" in text:
+		return ParsedItem(name, rarity, Kind.METAMORPH, "Metamorph", ilvl=ilvl)
+
+	if rarity == Rarity.MAGIC or rarity == Rarity.NORMAL:
+		itype = None
+
+	if rarity == Rarity.GEM:
+		kind = Kind.GEM
+		if "Vaal" in text and "Awakened" not in text:
+			itype = "Vaal " + name
 		else:
-			info = {'name': m[0][1], 'rarity': m[0][0], 'itype': m[0][0]}
+			itype = name
+	elif rarity == Rarity.UNIQUE:
+		kind = Kind.UNIQUE
 	else:
+		kind = Kind.ITEM
 
-		# get some basic info
-		info = {'name': m[0][1], 'rarity': m[0][0], 'itype': m[0][2]}
+	# Find all the affixes: the implicits (if any) and the explicits right after the item level.
+	mods = []
+	if mods_from is not None:
+		for section in sections[mods_from:]:
+			if any(line in MARKER_LINES for line in section):
+				break
+			if all(line.endswith(" (enchant)") for line in section):
+				continue
 
+			mods += section
+			if not all(line.endswith(" (implicit)") for line in section):
+				break
 
-	m = bool(re.search('Unidentified', text, re.M))
-	metamorph = bool(re.search("Tane", text, re.M))
+	return ParsedItem(name, rarity, kind, itype, ilvl=ilvl, quality=quality, links=links, corrupted=corrupted,
+			influence=influence, stats=mods)
 
 
-	# Oh, it's currency!
-	if info['rarity'] == 'Currency':
-		info['itype'] = info.pop('rarity')
-	elif info['rarity'] == 'Divination Card':
-		info['itype'] = info.pop('rarity')
-	elif info['rarity'] == 'Normal' and 'Scarab' in info['name']:
-		info['itype'] = 'Currency'
-	elif info['itype'] == "--------" and m: #Unided
-		info['itype'] = info['name']
-		# Item Level
-		m = re.findall(r'Item Level: (\d+)', text)
-
-		if m:
-			info['ilvl'] = int(m[0])
-	elif metamorph:
-		info['itype'] = "Metamorph"
-		m = re.findall(r'Item Level: (\d+)', text)
-
-		if m:
-			info['ilvl'] = int(m[0])
+@inflight.coalesce(lambda endpoint, league, j: cache_key(endpoint, league, j))
+def search(endpoint, league, j):
+	"""
+	Post a query to the "search" or "exchange" endpoint. If the same query was posted for the league within the last
+	SEARCH_CACHE_TTL seconds, the earlier result is returned instead. A search the trade site answers with an error
+	(still rate limited after the retries, an invalid query, ...) raises requests.HTTPError rather than passing for
+	a search without results.
 
-	else:
-		if info['rarity'] == 'Magic' or info['rarity'] == 'Normal':
-			info['itype'] = None
-
-		if info['rarity'] == 'Gem':
-			m = bool(re.search('Vaal', text, re.M))
-			a = bool(re.search('Awakened', text, re.M))
-			if m and not a:
-				info['itype'] = "Vaal " + info['name']
-			else:
-				info['itype'] = info['name']
+	returns JSON of the search result.
+	"""
+	with metrics.span('search', endpoint=endpoint):
+		key = cache_key(endpoint, league, j)
+		res = search_cache.get(key)
+		if res is not None:
+			metrics.add('search_cache_hits', endpoint=endpoint)
+			return res
+
+		query = api_request('POST', f'{endpoint}/{league}', json=j)
+		if query.status_code != 200:
+			raise requests.HTTPError(f"Trade search failed: HTTP {query.status_code}: {error_message(query)}",
+					response=query)
 
-		# Get Qual
-		m = re.findall(r'^Quality: +(\d+)%', text)
+		res = query.json()
+		search_cache.put(key, res)
+
+		return res
 
-		info['quality'] = int(m[0]) if m else 0
 
-		# Sockets and Links
-		m = re.findall(r'Sockets:(.*)', text)
+def error_message(res):
+	"""
+	The message of an error response from the trade API, like {"error": {"code": 2, "message": "Invalid query"}}.
+
+	returns string
+	"""
+	try:
+		error = res.json().get('error')
+	except ValueError:
+		return "unknown error"
 
-		if m:
-			info['links'] = len(m[0]) // 2
+	if isinstance(error, dict):
+		return error.get('message', "unknown error")
 
-		# Corruption status and influenced status
-		info['corrupted'] = bool(re.search('^Corrupted$', text, re.M))
+	return error or "unknown error"
 
-		info['influenced'] = {}
-		info['influenced']['shaper'] = bool(re.search('Shaper Item', text, re.M))
-		info['influenced']['elder'] = bool(re.search('Elder Item', text, re.M))
-		info['influenced']['crusader'] = bool(re.search('Crusader Item', text, re.M))
-		info['influenced']['hunter'] = bool(re.search('Hunter Item', text, re.M))
-		info['influenced']['redeemer'] = bool(re.search('Redeemer Item', text, re.M))
-		info['influenced']['warlord'] = bool(re.search('Warlord Item', text, re.M))
 
-		# Item Level
-		m = re.findall(r'Item Level: (\d+)', text)
+@metrics.timed('fetch_page')
+def fetch_page(ids, query_id, exchange = False):
+	"""
+	Fetch the listings of up to 10 result ids from a search. Listings fetched within the last SEARCH_CACHE_TTL seconds
+	come from the cache.
 
-		if m:
-			info['ilvl'] = int(m[0])
+	returns JSON of the listings, or None if the request failed.
+	"""
+	key = cache_key('fetch', ids, query_id, exchange)
+	listings = search_cache.get(key)
+	if listings is not None:
+		return listings
 
-		# Find all the affixes
-		m = re.findall(r'Item Level: \d+\n--------\n(.+)((?:\n.+)+)', text)
+	path = f'fetch/{",".join(ids)}?query={query_id}'
 
-		if m:
-			info['stats'] = []
-			info['stats'].append(m[0][0])
-			info['stats'].extend(m[0][1].split('\n'))
+	if exchange:
+		path += "&exchange=true"
 
-			# Clean up the leftover stuff / Make it useable data
-			if "(implicit)" in info['stats'][0]:
-				del info['stats'][1:2]
-			elif "--------" in info['stats']:
-				index = info['stats'].index('--------')
-				info['stats'] = info['stats'][:index]
-			else:
-				info['stats'] = info['stats'][:-1]
-			
-			if "" in info['stats']:
-				info['stats'].remove("")
+	res = api_request('GET', path)
+	if res.status_code != 200:
+		print(f'[!] Trade result retrieval failed: HTTP {res.status_code}! Message: {error_message(res)}')
+		return None
+
+	# Return the results from our fetch (this has who to whisper, prices, and more!)
+	listings = res.json()['result']
+	search_cache.put(key, listings)
+
+	return listings
+
+
+# The trade API fetches at most this many listings per request.
+PAGE_SIZE = 10
+
+
+class FetchPolicy:
+	"""
+	How deep to go into the listings of a search. Listings come cheapest first, so every page only adds dearer ones,
+	and once the cheap end of the market is known more pages mostly cost requests.
+
+	Fetching stops after max_pages pages, or once there are min_listings priced listings and the last page moved
+	their median price by no more than stable (0.1 being 10%). With stable None it stops as soon as there are
+	min_listings priced listings.
+
+	The pages needed for sure (see pages_ahead) are fetched side by side, so they take about as long as the slowest
+	of them. Every page after those is only requested once the one before said to go on, a round trip each: pages
+	past the sure ones are rare and the rate limit is what runs out, so a request is worth more than its latency.
+	"""
+	def __init__(self, min_listings = 10, max_pages = 5, stable = 0.1):
+		self.min_listings = min_listings
+		self.max_pages = max_pages
+		self.stable = stable
+
+	def pages_ahead(self):
+		"""
+		Pages that are needed for sure: enough for min_listings, and at least two to tell whether prices are stable
+		(when that's asked for), as stop_reason compares the last page with the ones before it.
+		"""
+		pages = max(-(-self.min_listings // PAGE_SIZE), 1 if self.stable is None else 2)
+		return min(pages, self.max_pages)
+
+	def stop_reason(self, listings, page):
+		"""
+		Decide whether to fetch more, listings being everything fetched so far and page the last page of it.
+
+		returns why to stop ("enough", "stable"), or None to go on.
+		"""
+		priced = [listing for listing in listings if listing['listing']['price']]
+		if len(priced) < self.min_listings:
+			return None
+		if self.stable is None:
+			return "enough"
+
+		before = median_price(listings[:len(listings) - len(page)])
+		after = median_price(listings)
+		if before and after and before[0] == after[0] and after[1] <= before[1] * (1 + self.stable):
+			return "stable"
+
+		return None
+
+
+# How deep fetch and show_prices go, see FetchPolicy. Set by the --min-listings, --max-pages and --stable options.
+FETCH_POLICY = FetchPolicy()
+
+
+def median_price(listings):
+	"""
+	The median price of listings, among those priced in the currency most of them are in.
+
+	returns tuple (currency, amount), or None if none of them have a price.
+	"""
+	prices = {}
+	for listing in listings:
+		price = listing['listing']['price']
+		if price:
+			prices.setdefault(price['currency'], []).append(price['amount'])
+	if not prices:
+		return None
+
+	(currency, amounts) = max(prices.items(), key=lambda item: len(item[1]))
+	amounts.sort()
+	return (currency, amounts[len(amounts) // 2])
 
-	return info
 
+def iter_fetch(q_res, exchange = False, max_pages = None, first = 1):
+	"""
+	Fetch the listings of a search page by page, cheapest first. The first pages are requested right away, side by
+	side, and every page after them only when the reader asks for it. The pages come in order, so the cheapest
+	listings can be shown while the rest are still on their way. Stopping early (or closing the generator) cancels
+	the pages that weren't sent yet.
+
+	returns generator of lists of listings, stopping at the first page that couldn't be fetched.
+	"""
+	if max_pages is None:
+		max_pages = FETCH_POLICY.max_pages
+	# Search results list at most 100 ids, fetch up to max_pages of them.
+	cap = min(len(q_res['result']), max_pages * PAGE_SIZE)
+
+	pages = [q_res['result'][i:i+PAGE_SIZE] for i in range(0, cap, PAGE_SIZE)]
+	requested = [submit(fetch_page, ids, q_res['id'], exchange) for ids in pages[:max(first, 1)]]
+	try:
+		for i in range(len(pages)):
+			page = requested[i].result()
+			if page is None:
+				return
+
+			yield page
+			# The reader wants more, so request the next page if it isn't yet.
+			if len(requested) == i + 1 and i + 1 < len(pages):
+				requested.append(submit(fetch_page, pages[i + 1], q_res['id'], exchange))
+	finally:
+		for future in requested:
+			future.cancel()
+
+
+def fetch_listings(q_res, exchange = False, policy = None):
+	"""
+	Fetch the listings of a search as deep as policy (FETCH_POLICY by default) says is worth it. The pages the policy
+	needs for sure are requested at once, every page after them only once the policy said to go on, so no page is
+	fetched just to be thrown away.
+
+	returns generator of lists of listings, like iter_fetch.
+	"""
+	policy = policy or FETCH_POLICY
+	listings = []
+	with contextlib.closing(iter_fetch(q_res, exchange, policy.max_pages, policy.pages_ahead())) as pages:
+		for page in pages:
+			listings += page
+			yield page
+
+			reason = policy.stop_reason(listings, page)
+			if reason:
+				metrics.add('fetch_stopped', reason=reason)
+				return
+
+	# Out of result ids, pages or pages that could be fetched.
+	metrics.add('fetch_stopped', reason="end")
 
+
+@inflight.coalesce(lambda q_res, exchange = False: (q_res['id'], exchange))
+@metrics.timed('fetch')
 def fetch(q_res, exchange = False):
 	"""
 	Fetch is the last step of the API. The item's attributes are decided, and this function checks to see if
-	there are any similar items like it listed.
+	there are any similar items like it listed. Only as many pages as FETCH_POLICY says are fetched.
 
 	returns JSON of all available similar items.
 	"""
-
 	results = []
-	# Limited to crawling by 10 results at a time due to API restrictions, so check first 50
-	DEFAULT_CAP = 50
-	DEFAULT_INTERVAL = 10
-	cap = DEFAULT_CAP
-	interval = DEFAULT_INTERVAL
-
-	# If there's less than 10 results, change to the number there is.
-	if len(q_res) < DEFAULT_CAP:
-		cap = int((len(q_res) / 10) * 10)
-
-	# Find all the results
-	for i in range(0, cap, interval):
-		url = f'https://www.pathofexile.com/api/trade/fetch/{",".join(q_res["result"][i:i+10])}?query={q_res["id"]}'
-
-		if exchange:
-			url += "exchange=true"
-
-		res = requests.get(url)
-		if res.status_code != 200:
-			print(f'[!] Trade result retrieval failed: HTTP {res.status_code}! '
-					f'Message: {res.json().get("error", "unknown error")}')
-			break
-
-		# Return the results from our fetch (this has who to whisper, prices, and more!)
-		results += res.json()['result']
+	for page in fetch_listings(q_res, exchange):
+		results += page
 
 	return results
 
 
-def query_trade(name = None, ilvl = None, itype = None, links = None, corrupted = None, influenced = None, rarity = None, league = 'Metamorph', stats = []):
+def query_trade(item, league = 'Metamorph'):
+	"""
+	Search for an item and fetch the listings found.
+
+	returns results of the fetch function.
+	"""
+	res = search_trade(item, league)
+	if res is None:
+		return []
+
+	return fetch(res)
+
+
+@inflight.coalesce(lambda item, league = 'Metamorph': (item, league))
+@metrics.timed('search_trade')
+def search_trade(item, league = 'Metamorph'):
 	"""
 	Build JSON for fetch request of an item for trade.
 	Take all the parsed item info, and construct JSON based off of it.
+	Uniques are only searched by name, links and corrupted status.
 
-	returns results of the fetch function.
+	returns JSON of the search result, or None if nothing like the item is listed.
 	"""
 	# Basic JSON structure
 	j = {'query':{'filters':{}}, 'sort': {'price': 'asc'}}
 
-	# If unique, Div Card, or Gem search by name
-	if rarity == "Unique" or itype == "Divination Card":
-		j['query']['name'] = name
+	# If unique or Div Card search by name
+	if item.kind == Kind.UNIQUE or item.kind == Kind.DIVINATION_CARD:
+		j['query']['name'] = item.name
 
-	if itype == "Metamorph":
+	if item.kind == Kind.METAMORPH:
 		mm_parts = ["Brain", "Lung", "Eye", "Heart", "Liver"]
 
 		for part in mm_parts:
-			if part in name:
-				del j['query']['name']
+			if part in item.name:
 				j['query']['type'] = "Metamorph " + part
 
 	# Set itemtype. TODO: change to allow similar items of other base types... Unless base matters...
-	elif itype:
-		j['query']['type'] = itype
+	elif item.itype and item.kind != Kind.UNIQUE:
+		j['query']['type'] = item.itype
 
 	# Only search for items online
 	j['query']['status'] = {}
 	j['query']['status']['option'] = 'online'
 
-	# Set required links
-	if links:
-		j['query']['filters']['socket_filters'] = {'filters': {'links': {'min': links}}}
+	# Only search for items with a price, unpriced listings don't tell us anything.
+	j['query']['filters']['trade_filters'] = {'filters': {'sale_type': {'option': 'priced'}}}
 
-	# Set corrupted status
-	if corrupted:
-		j['query']['filters']['misc_filters'] = {'filters': {'corrupted': {'option': 'true'}}}
+	# Set required links
+	if item.links:
+		j['query']['filters']['socket_filters'] = {'filters': {'links': {'min': item.links}}}
 
 	j['query']['filters']['misc_filters'] = {}
 	j['query']['filters']['misc_filters']['filters'] = {}
 
-	# Set influenced status
-	if influenced:
-		if True in influenced.values():
-			for influence in influenced:
-				if influenced[influence]:
-					j['query']['filters']['misc_filters']['filters'][influence + "_item"] = "true"
+	# Set corrupted status
+	if item.corrupted:
+		j['query']['filters']['misc_filters']['filters']['corrupted'] = {'option': 'true'}
+
+	if item.kind == Kind.UNIQUE:
+		stats = ()
+	else:
+		stats = item.stats
 
+		# Set influenced status
+		for influence in item.influences:
+			j['query']['filters']['misc_filters']['filters'][influence + "_item"] = "true"
 
-	if (name == itype or rarity == 'Normal' or rarity == 'Magic' or itype == 'Metamorph') and ilvl != None: #Unidentified item
-		j['query']['filters']['misc_filters']['filters']['ilvl'] = {'min': ilvl - 3, 'max': ilvl + 3}
+		if (item.kind in (Kind.UNIDENTIFIED, Kind.GEM, Kind.METAMORPH) or item.rarity in (Rarity.NORMAL, Rarity.MAGIC)) and item.ilvl is not None:
+			j['query']['filters']['misc_filters']['filters']['ilvl'] = {'min': item.ilvl - 3, 'max': item.ilvl + 3}
 
-	fetch_called = False
 	# Find every stat
 	if stats:
 		j['query']['stats'] = [{}]
 		j['query']['stats'][0]['type'] = 'and'
 		j['query']['stats'][0]['filters'] = []
 		for stat in stats:
-			(proper_affix, value) = find_affix_match(stat)
+			(proper_affix, values) = find_affix_match(stat)
 			affix_types = ["implicit", "crafted", "explicit"]
 			if any(atype in proper_affix for atype in affix_types): #If proper_affix is an actual mod...
-				j['query']['stats'][0]['filters'].append({'id': proper_affix, 'value': {'min': value, 'max': 999}})
+				j['query']['stats'][0]['filters'].append({'id': proper_affix, 'value': {'min': affix_value(values), 'max': 999}})
 
 		# Turn life + resists into pseudo-mods
 		j = create_pseudo_mods(j)
 
-		# Now search for similar items, if none found remove a stat and try again. TODO: Refactor and include more vars.
-		num_stats_ignored = 0
-		total_num_stats = len(j['query']['stats'][0]['filters'])
-		while len(j['query']['stats'][0]['filters']) > 0:
+		# Now search for similar items. If none are found, find the most mods we can match instead.
+		filters = j['query']['stats'][0]['filters']
+		if filters:
+			return relax_mods(j, league)
+
+	# Any time we ignore stats.
+	return search('search', league, j)
+
+
+@metrics.timed('relax')
+def relax_mods(j, league):
+	"""
+	Search for the item with as many of its mods as there are results for, and fetch those results.
+
+	Rather than dropping one mod per search, this bisects over how many of the mods have to match (a "count" stat
+	group), so an item with n mods takes about log2(n) searches. The priority mods are kept until nothing can be
+	found with them. Only priced listings are searched for, so the search's total is all it takes to decide whether
+	to relax further, without fetching anything.
+
+	returns JSON of the search result, or None if nothing was found even without mods.
+	"""
+	filters = j['query']['stats'][0]['filters']
+	required = [f for f in filters if f['id'] in PRIORITY_MODS]
+	optional = [f for f in filters if f['id'] not in PRIORITY_MODS]
+	most = len(optional)
+	searches = 0
+
+	while True:
+		(res, k, tries) = most_mods_matched(j, league, required, optional, most)
+		searches += tries
+		metrics.add('relax_searches', tries)
+
+		if res is None and required:
+			# Not even the priority mods find anything, so let those go too.
+			print("[-] No results with the" + Fore.CYAN + " pseudo " + Fore.WHITE + "mods, relaxing them as well.")
+			(required, optional) = ([], required + optional)
+			most = len(optional) - 1
+			continue
+
+		if res is None:
+			return None
+
+		matched = len(required) + k
+		if matched < len(filters):
+			print(f"[-] Found results with {matched} of the {len(filters)} mods" + Fore.RED + " (no results with all of them)" + Fore.WHITE + f", after {searches} searches.")
+
+			# The count group doesn't say which k of the optional mods a result has, so any of them may be the missing ones.
+			missing = len(optional) - k
+			mods = ", ".join(stat_translate(i) for i in optional)
+			if k:
+				print(f"[-] Results may lack any {missing} of the" + Fore.CYAN + f" {mods} " + Fore.WHITE + "mods.")
+			else:
+				print("[-] Removing the" + Fore.CYAN + f" {mods} " + Fore.WHITE + "mods from the list due to" + Fore.RED + " no results found.")
 
 			# If we ignore more than half of the stats, it's not accurate
-			if num_stats_ignored > (int(total_num_stats * 0.6)):
+			if len(filters) - matched > int(len(filters) * 0.6):
 				print(f"[!] Take any values after this with a grain of salt. You should probably do a" + Fore.RED + " MANUAL search")
+		else:
+			print(f"[*] Found results with all {len(filters)} mods after {searches} searches.")
+
+		return res
 
-			# Make the actual request.
-			query = requests.post(f'https://www.pathofexile.com/api/trade/search/{league}', json=j)
 
-			# No results found. Trim the mod list until we find results.
-			if (len(query.json()['result'])) == 0:
-				
-				# Choose a non-priority mod
-				i = choose_bad_mod(j)
+def mod_count_query(j, required, optional, k):
+	"""
+	Copy j, asking for all the required mods and at least k of the optional ones.
 
-				# Tell the user which mod we are deleting
-				print("[-] Removing the" + Fore.CYAN + f" {stat_translate(i)} " + Fore.WHITE + "mod from the list due to" + Fore.RED + " no results found.")
+	returns dictionary
+	"""
+	groups = []
+	if required:
+		groups.append({'type': 'and', 'filters': required})
+	if optional and k:
+		groups.append({'type': 'count', 'value': {'min': k}, 'filters': optional})
 
-				# Remove bad mod.
-				j['query']['stats'][0]['filters'].remove(i)
-				num_stats_ignored += 1
-			else: # Found a result!
-				res = query.json()
-				fetch_called = True
-				results = fetch(res)
+	query = dict(j)
+	query['query'] = dict(j['query'], stats=groups or [{'type': 'and', 'filters': []}])
+	return query
 
 
-				if result_prices_are_none(results):
-					# Choose a non-priority mod
-					i = choose_bad_mod(j)
+def most_mods_matched(j, league, required, optional, most):
+	"""
+	Find the largest k (at most most) for which searching with all the required mods and k of the optional ones has
+	results. k = most is tried first, as that's the usual case, then the rest is bisected.
 
-					# Tell the user which mod we are deleting
-					print("[-] Removing the" + Fore.CYAN + f" {stat_translate(i)} " + Fore.WHITE + "mod from the list due to" + Fore.RED + " no results found.")
+	returns tuple (search result or None if nothing was found, k, searches made). A failed search raises, see search,
+	so an error is never taken for a k without results.
+	"""
+	res = search('search', league, mod_count_query(j, required, optional, most))
+	if search_total(res):
+		return (res, most, 1)
+
+	found = (None, -1)
+	searches = 1
+	(lo, hi) = (0, most - 1)
+	while lo <= hi:
+		k = (lo + hi + 1) // 2
+		res = search('search', league, mod_count_query(j, required, optional, k))
+		searches += 1
+		if search_total(res):
+			found = (res, k)
+			lo = k + 1
+		else:
+			hi = k - 1
 
-					# Remove bad mod.
-					j['query']['stats'][0]['filters'].remove(i)
-					num_stats_ignored += 1
-				else:
-					return results
+	return found + (searches,)
 
-	if not fetch_called: # Any time we ignore stats.
-		query = requests.post(f'https://www.pathofexile.com/api/trade/search/{league}', json=j)
-		res = query.json()
-		results = fetch(res)
-		return results
 
 def create_pseudo_mods(j):
 	"""
@@ -402,268 +1036,428 @@ def create_pseudo_mods(j):
 
 	return j
 
-def choose_bad_mod(j):
+def search_total(res):
 	"""
-	Chooses a non-priority mod to delete.
+	Number of listings a search found. Falls back to the number of result ids for responses without a total.
 
-	Returns dictionary
+	returns int
 	"""
-	# Good mod list
-	priority = [
-		'pseudo.pseudo_total_elemental_resistance',
-		'pseudo.pseudo_total_chaos_resistance',
-		'pseudo.pseudo_total_life'
-	]
+	return res.get('total', len(res.get('result', [])))
 
-	# Choose a non-priority mod to delete
-	for i in j['query']['stats'][0]['filters']:
-		if i['id'] not in priority:
-			break
-	
-	return i
 
+# What to price currency in through the bulk exchange, best first.
+EXCHANGE_CURRENCIES = ['chaos', 'exa', 'mir']
 
-def result_prices_are_none(j):
-	"""
-	Determine if item is unpriced or not.
 
-	Returns BOOLEAN
+def query_exchange(qcur, league='Metamorph'):
 	"""
-	for listing in j:
-		if listing['listing']['price'] == None:
-			return True
+	Search the bulk exchange for a currency and fetch the offers found.
 
-	return False
+	returns results of the fetch function.
+	"""
+	return fetch(search_exchange(qcur, league), exchange = True)
 
 
-def query_exchange(qcur, league='Metamorph'):
+@inflight.coalesce(lambda qcur, league = 'Metamorph': (qcur, league))
+@metrics.timed('search_exchange')
+def search_exchange(qcur, league='Metamorph'):
 	"""
 	Build JSON for fetch request of wanted currency exchange.
+
+	returns JSON of the search result.
 	"""
 
 	print(f"[*] All values will be reported as their chaos, exalt, or mirror equivalent.")
-	IG_CURRENCY = [CURRENCY, OILS, CATALYSTS, FRAGMENTS_AND_SETS, INCUBATORS, SCARABS, RESONATORS,
-				FOSSILS, VIALS, ESSENCES, DIV_CARDS]
+	match = find_currency(qcur)
+	selection = match[1] if match else "Exalt"
 
-	selection = "Exalt"
-	if any(d.get(qcur, None) for d in IG_CURRENCY):
-		for curr_type in IG_CURRENCY:
-			if qcur in curr_type:
-				selection = curr_type[qcur]
 
-
-	# Default JSON
-	for haveCurrency in ['chaos', 'exa', 'mir']:
+	# Ask for all of them at once, then take the first in order of EXCHANGE_CURRENCIES that has results. A failed
+	# probe raises (see search) instead of passing for one without offers.
+	probes = []
+	for haveCurrency in EXCHANGE_CURRENCIES:
 		def_json = {'exchange': {'have': [haveCurrency], 'want': [selection], 'status': {'option': 'online'}}}
+		probes.append(submit(search, 'exchange', league, def_json))
 
-		query = requests.post(f'https://www.pathofexile.com/api/trade/exchange/{league}', json=def_json)
-		res = query.json()
-
-		if len(res['result']) == 0:
-			continue
-		else:
+	for probe in probes:
+		res = probe.result()
+		if search_total(res):
 			break
 
+	return res
 
-	results = fetch(res, exchange = True)
-	return results
 
-
-def affix_equals(text, affix):
+def affix_template(affix):
 	"""
-	Clean up the affix to match the given text so we can find the correct id to search with.
+	Turn a copied mod into the text the stats catalog uses for it: every number becomes "#" and "+" signs are dropped.
+	"Adds 20 to 33 Fire Damage" becomes "Adds # to # Fire Damage" with values (20, 33).
 
-	returns tuple (BOOLEAN, value)
+	returns tuple (template, values)
 	"""
-	value = 0
-	match = re.findall(r"\d+", affix)
-	if len(match) > 0:
-		value = match[0]
-	query = re.sub(r"\d+", "#", affix)
-	query = re.sub(r"\+", "", query)
+	values = []
 
+	def slot(m):
+		number = m.group()
+		values.append(float(number) if "." in number else int(number))
+		return "#"
 
-	if query.endswith(r" (implicit)"):
-		text = text + r" (implicit)"
+	template = AFFIX_NUMBER.sub(slot, affix).replace("+", "")
 
-	if query.endswith(r" (crafted)"):
-		text = text + r" (crafted)"
+	return (template, tuple(values))
 
-	if query.endswith(r" (pseudo)"):
-		text = text + r" (pseudo)"
-		query = r"+" + query
 
-	if text.endswith("(Local)"):
-		query = query + r" (Local)"
+def affix_value(values):
+	"""
+	The value to search a mod with. Mods with a range ("Adds # to #") are searched by their average, like the trade
+	site does.
 
-	if text == query:
-		print("[+] Found mod " + Fore.GREEN + f"+{value}{text[1:]}") #TODO: support "# to # damage to attacks" type mods and other similar
-		return (True, value)
+	returns number
+	"""
+	if not values:
+		return 0
+	if len(values) == 1:
+		return values[0]
 
-	return (False, 0)
+	return sum(values) / len(values)
 
 
+@metrics.timed('match')
 def find_affix_match(affix):
 	"""
 	Search for the proper id to return the correct results.
 
-	returns tuple (id of the affix requested. value)
+	returns tuple (id of the affix requested, values)
 	"""
-	pseudos = stats['result'][0]['entries']
-	explicits = stats['result'][1]['entries']
-	implicits = stats['result'][2]['entries']
-	crafted = stats['result'][5]['entries']
-	proper_affix = ("", 0)
-
 	if "(pseudo)" in affix:
-		for pseudo in pseudos:
-			(match, value) = affix_equals(pseudo['text'], affix)
-			if match:
-				proper_affix = (pseudo['id'], value)
-
+		kind = 'pseudo'
 	elif "(implicit)" in affix:
-		for implicit in implicits:
-			(match, value) = affix_equals(implicit['text'], affix)
-			if match:
-				proper_affix = (implicit['id'], value)
-
+		kind = 'implicit'
 	elif "(crafted)" in affix:
-		for craft in crafted:
-			(match, value) = affix_equals(craft['text'], affix)
-			if match:
-				proper_affix = (craft['id'], value)
-
+		kind = 'crafted'
 	else:
-		for explicit in explicits:
-			(match, value) = affix_equals(explicit['text'], affix)
-			if match:
-				proper_affix = (explicit['id'], value)
+		kind = 'explicit'
+
+	(template, values) = affix_template(affix)
 
-	return proper_affix
+	# The catalog doesn't tag its texts with the kind of stat, and pseudo stats keep their "+".
+	if kind != 'explicit':
+		suffix = f" ({kind})"
+		if not template.endswith(suffix):
+			return ("", ())
+		template = template[:-len(suffix)]
+	if kind == 'pseudo':
+		template = "+" + template
+
+	match = get_affix_index()[kind].get(template)
+	if not match:
+		return ("", ())
+
+	(stat_id, text) = match
+	if text.endswith(" (Local)"):
+		affix += " (Local)"
+	print("[+] Found mod " + Fore.GREEN + affix)
+
+	return (stat_id, values)
 
 
 def stat_translate(jaffix):
 	"""
-	Translate id to the equivalent stat.
+	Translate id to the equivalent stat, e.g. "# to maximum Life". Falls back to the id for stats the stats catalog
+	doesn't have.
+	"""
+	return get_stat_text(jaffix['id']) or jaffix['id']
+
+
+@metrics.timed('price')
+def price_item(item):
+	"""
+	Look up the price of a parsed item: through the bulk exchange for currency and divination cards, through the
+	item search for everything else.
+
+	returns results of the fetch function.
+	"""
+	(res, exchange) = find_listings(item)
+	if res is None:
+		return []
+
+	return fetch(res, exchange)
+
+
+def find_listings(item):
+	"""
+	Search for listings like a parsed item, see price_item.
+
+	returns tuple (JSON of the search result or None if nothing was found, whether it's a bulk exchange search)
 	"""
-	affix = jaffix['id']
+	# Uniques, only search by corrupted status, links, and name.
+	if item.kind == Kind.UNIQUE:
+		print(f'[*] Found Unique item in clipboard: {item.name} {item.itype}')
+		base = f'Only showing results that are: '
+
+		if item.corrupted:
+			base += f"Corrupted "
 
-	pseudos = stats['result'][0]['entries']
-	explicits = stats['result'][1]['entries']
-	implicits = stats['result'][2]['entries']
-	crafted = stats['result'][5]['entries']
+		if item.links and item.links > 1:
+			base += f"{item.links} linked "
+
+		print("[-]", base)
+
+		return (search_trade(item), False)
+
+	elif item.kind == Kind.CURRENCY:
+		print(f'[-] Found currency {item.name} in clipboard')
+		return (search_exchange(item.name), True)
+
+	elif item.kind == Kind.DIVINATION_CARD:
+		print(f'[-] Found Divination Card {item.name}')
+		return (search_exchange(item.name), True)
 
-	if "pseudo" in affix:
-		return find_stat_by_id(affix, pseudos)
-	elif "implicit" in affix:
-		return find_stat_by_id(affix, implicits)
-	elif "crafted" in affix:
-		return find_stat_by_id(affix, crafted)
 	else:
-		return find_stat_by_id(affix, explicits)
+		# Do intensive search.
+		if item.itype != item.name and item.itype != None:
+			print(f"[*] Found {item.rarity.value} item in clipboard: {item.name} {item.itype}")
+		else:
+			print(f"[*] Found {item.rarity.value} item in clipboard: {item.name}")
+
+		return (search_trade(item), False)
 
 
-def find_stat_by_id(affix, stat_list):
+
+@metrics.timed('price')
+def show_prices(item):
 	"""
-	Helper function to find stats by their id.
+	Price a parsed item like price_item, printing the prices as every page of listings comes in, cheapest first.
+	Listings with the same price are printed as one "count x price". Pages are fetched as far as FETCH_POLICY says.
+
+	returns the listings shown.
 	"""
-	for stat in stat_list:
-		if stat['id'] == affix:
-			return stat['text']
+	(res, exchange) = find_listings(item)
+	if not res or not res.get('result'):
+		print(f'[!] No results!')
+		return []
+
+	if len(res['result']) == 1:
+		listings = fetch(res, exchange)
+		if listings:
+			price = listings[0]['listing']['price']
+			if price != None:
+				price = f"{price['amount']} x {price['currency']}"
+			print("[!] Found one result with" + Fore.YELLOW + f" {price} " + Fore.WHITE + "as the price.\n\n")
+		return listings
+
+	listings = []
+	shown = 0
+	# [price, count] of the latest price, printed once another price comes (or the listings end).
+	bucket = None
+	started = False
+
+	def print_bucket():
+		nonlocal started
+		start = ", " if started else "[!] Lowest prices: "
+		print(start + f"{bucket[1]} x " + Fore.YELLOW + f"{bucket[0]}" + Fore.WHITE, end="", flush=True)
+		started = True
+
+	for page in fetch_listings(res, exchange):
+		for listing in page:
+			listings.append(listing)
+			price = listing['listing']['price']
+			if price is None:
+				continue
+
+			price = f"{price['amount']} {price['currency']}"
+			if bucket and bucket[0] == price:
+				bucket[1] += 1
+			else:
+				if bucket:
+					print_bucket()
+				bucket = [price, 1]
+			shown += 1
+
+	if bucket:
+		print_bucket()
+		print(f" ({shown} of {search_total(res)} listings)\n\n")
+	else:
+		print(f'[!] No results!')
+
+	return listings
+
+
+def price_traced(item, price = price_item):
+	"""
+	Price an item with price (price_item or show_prices), writing a trace of it to trace_file (see --trace) when
+	tracing.
+
+	returns what price returns.
+	"""
+	if trace_file is None:
+		return price(item)
+
+	trace = metrics.trace(item.name)
+	try:
+		with trace:
+			return price(item)
+	finally:
+		with _trace_lock:
+			write_json_line(trace_file, trace.to_dict())
+
+
+def read_items(lines):
+	"""
+	Split a stream of lines (a file, stdin...) into copied items. Items are separated by blank lines.
+
+	returns generator of item texts, each yielded as soon as its last line is read.
+	"""
+	item = []
+	for line in lines:
+		if line.strip():
+			item.append(line.rstrip('\r\n'))
+		elif item:
+			yield "\n".join(item)
+			item = []
+
+	if item:
+		yield "\n".join(item)
+
+
+def price_batch(texts, out = sys.stdout, workers = BATCH_WORKERS):
+	"""
+	Price a whole batch of copied items (e.g. a stash dump), writing one JSON line per item to out as soon as it's
+	priced, so lines come out while the rest of the batch is still being read. Identical items priced at the same
+	time are only searched once, and all searches share the rate limiter.
+	Lines look like {"index": 0, "name": ..., "type": ..., "kind": ..., "prices": [{"amount": 1, "currency": "chaos"}, ...]},
+	prices being cheapest first. Texts that aren't items, and items whose price check failed, get "error" instead of
+	prices.
+	"""
+	# Every distinct item being priced, with the indexes of the texts it came from.
+	pending = {}
+	lock = threading.Lock()
+	# Items being priced at most, so reading a huge batch doesn't queue up all of it.
+	in_flight = threading.BoundedSemaphore(BATCH_AHEAD * workers)
+
+	def done(future, item):
+		line = {'name': item.name, 'type': item.itype, 'kind': item.kind.value}
+		try:
+			try:
+				line['prices'] = [listing['listing']['price'] for listing in future.result() or []]
+			except Exception as e:
+				# Whatever went wrong, every item still gets its line.
+				line['error'] = str(e) or e.__class__.__name__
+
+			with lock:
+				for index in pending.pop(item):
+					write_json_line(out, dict(index=index, **line))
+		finally:
+			in_flight.release()
+
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+		for (index, text) in enumerate(texts):
+			item = parse_item_info(text)
+			if item is None:
+				with lock:
+					write_json_line(out, {'index': index, 'error': 'not an item'})
+				continue
+
+			with lock:
+				if item in pending:
+					pending[item].append(index)
+					continue
+				pending[item] = [index]
+
+			in_flight.acquire()
+			pool.submit(price_traced, item).add_done_callback(lambda future, item=item: done(future, item))
+
+
+def record_rate_limits():
+	"""
+	Set the rate_limit_remaining gauges to the requests every rate limit window has left, see RateLimiter.remaining.
+	"""
+	for (policy, windows) in limiter.remaining().items():
+		for (window, hits) in windows.items():
+			metrics.gauge('rate_limit_remaining', hits, policy=policy, window=window)
+
+
+def write_json_line(out, obj):
+	out.write(json.dumps(obj) + "\n")
+	out.flush()
 
 
 def watch_clipboard():
 	"""
 	Watch clipboard for items being copied to check lowest prices on trade.
+	Items are priced in the background (see engine.py), so copying another item while one is being priced moves on
+	to the new one right away.
 	"""
 	print('[*] Watching clipboard (Ctrl+C to stop)...')
+	clipboard = open_clipboard(root)
+	engine = PricingEngine(lambda item: price_traced(item, show_prices))
 	prev = None
 	while True:
 		try:
-			text = root.clipboard_get()
-		except TclError:	 # ignore non-text clipboard contents
-			continue
-		try:
+			clipboard.wait()
+			text = clipboard.get_text()
+			if text is None:	 # ignore non-text clipboard contents
+				continue
+
 			if text != prev:
-				info = parse_item_info(text)
-				trade_info = None
-
-				if info:
-					# Uniques, only search by corrupted status, links, and name.
-					if (info.get('rarity') == 'Unique') and (info.get('itype') != "Metamorph"):
-						print(f'[*] Found Unique item in clipboard: {info["name"]} {info["itype"]}')
-						base = f'Only showing results that are: '
-
-						if info['corrupted']:
-							base += f"Corrupted "
-
-						if "links" in info:
-							if info['links'] > 1:
-								base += f"{info['links']} linked "
-
-						print("[-]", base)
-
-						trade_info = query_trade(**{k:v for k, v in info.items() if k in ('name', 'links',
-								'corrupted', 'rarity')})
-
-					elif info['itype'] == 'Currency':
-						print(f'[-] Found currency {info["name"]} in clipboard')
-						trade_info = query_exchange(info['name'])
-
-					elif info['itype'] == 'Divination Card':
-						print(f'[-] Found Divination Card {info["name"]}')
-						trade_info = query_exchange(info['name'])
-
-					else:
-						# Do intensive search.
-						if info['itype'] != info['name'] and info['itype'] != None:
-							print(f"[*] Found {info['rarity']} item in clipboard: {info['name']} {info['itype']}")
-						else:
-							print(f"[*] Found {info['rarity']} item in clipboard: {info['name']}")
-
-						trade_info = query_trade(**{k:v for k, v in info.items() if k in ('name', 'itype', 'ilvl', 'links',
-								'corrupted', 'influenced', 'stats', 'rarity')})
-					
-					# If results found
-					if trade_info:
-						# If more than 1 result, assemble price list.
-						if len(trade_info) > 1:
-							# Modify data to usable status.
-							prices = [x['listing']['price'] for x in trade_info]
-							prices = ['%(amount)s%(currency)s' % x for x in prices]
-
-							prices = {x:prices.count(x) for x in prices}
-							print_string = ""
-							total_count = 0
-
-							# Make pretty strings.
-							for price_dict in prices:
-								pretty_price = " ".join(re.split(r"([0-9.]+)", price_dict)[1:])
-								print_string += f"{prices[price_dict]} x " + Fore.YELLOW + f"{pretty_price}" + Fore.WHITE + ", "
-								total_count += prices[price_dict]
-
-							# Print the pretty string, ignoring trailing comma 
-							print(f'[!] Lowest {total_count} prices: {print_string[:-2]}\n\n')
-
-						else:
-							price = trade_info[0]['listing']['price']
-							if price != None:
-								price = f"{price['amount']} x {price['currency']}"
-							print("[!] Found one result with" + Fore.YELLOW + f" {price} " + Fore.WHITE + "as the price.\n\n")
-
-					elif trade_info is not None:
-						print(f'[!] No results!')
+				clipboard.changed()
+				item = parse_item_info(text)
+
+				if item:
+					engine.submit(item)
 
 				prev = text
-			time.sleep(.3)
 
 		except KeyboardInterrupt:
 			break
 
+	engine.close()
+	clipboard.close()
+
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Price Path of Exile items copied in-game on the official trade site.")
+	parser.add_argument('--batch', metavar='FILE', help="price every item in FILE (- for stdin), separated by blank "
+			"lines, and print one JSON line per item instead of watching the clipboard")
+	parser.add_argument('--trace', metavar='FILE', help="write a JSON line per price check to FILE (- for stderr) with "
+			"the time each stage and request took")
+	parser.add_argument('--metrics', metavar='FILE', help="write request counts, bytes, rate limit waits, the "
+			"rate limits left and stage timings to FILE (- for stderr) in the Prometheus text format when done")
+	parser.add_argument('--min-listings', type=int, default=FETCH_POLICY.min_listings, metavar='N',
+			help="priced listings to fetch before stopping is considered (default %(default)s)")
+	parser.add_argument('--max-pages', type=int, default=FETCH_POLICY.max_pages, metavar='N',
+			help=f"most pages of {PAGE_SIZE} listings to fetch per item (default %(default)s)")
+	parser.add_argument('--stable', type=float, default=FETCH_POLICY.stable * 100, metavar='PCT',
+			help="stop fetching once a page moves the median price by no more than PCT%% (default %(default)s)")
+	args = parser.parse_args()
+	FETCH_POLICY = FetchPolicy(args.min_listings, args.max_pages, args.stable / 100)
+
 	init(autoreset=True) #Colorama
-	root = Tk()
-	root.withdraw()
-	watch_clipboard()
-	deinit() #Colorama
\ No newline at end of file
+	# Only rares need the stats, so let the clipboard watching start right away.
+	prefetch(load_stat_indexes)
+	if PERSIST_SEARCHES:
+		search_cache.load(os.path.join(CACHE_DIR, "searches.json"))
+	if args.trace:
+		trace_file = sys.stderr if args.trace == '-' else open(args.trace, "a", encoding="utf-8")
+
+	if args.batch:
+		out = sys.stdout
+		items = sys.stdin if args.batch == '-' else open(args.batch, encoding="utf-8")
+		# Keep stdout for the JSON lines, everything else goes to stderr.
+		with items, contextlib.redirect_stdout(sys.stderr):
+			price_batch(read_items(items), out)
+	else:
+		root = Tk()
+		root.withdraw()
+		watch_clipboard()
+
+	if PERSIST_SEARCHES:
+		search_cache.save(os.path.join(CACHE_DIR, "searches.json"))
+	cache_stats = search_cache.stats()
+	print(f"[*] Search cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.", file=sys.stderr)
+	record_rate_limits()
+	if args.metrics == '-':
+		sys.stderr.write(metrics.prometheus())
+	elif args.metrics:
+		with open(args.metrics, "w", encoding="utf-8") as f:
+			f.write(metrics.prometheus())
+	deinit() #Colorama
@@ -1,12 +1,15 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
 block_cipher = None
+# Ship the currency snapshot when gen_currency.py has made one.
+datas = [('currency.json', '.')] if os.path.exists('currency.json') else []
 
 
 a = Analysis(['parse.py'],
              pathex=['/home/ethck/Documents/Projects/poeTradeLookup'],
              binaries=[],
-             datas=[],
+             datas=datas,
              hiddenimports=[],
              hookspath=[],
              runtime_hooks=[],
@@ -0,0 +1,215 @@
+# Keeps our requests inside the trade API's rate limits.
+#
+# Every response from the trade API says which policy the request fell under and how that policy is limited:
+#   X-Rate-Limit-Policy: trade-search-request-limit
+#   X-Rate-Limit-Rules: Ip,Account
+#   X-Rate-Limit-Ip: 8:10:60,15:60:300         (max hits : period in seconds : lockout in seconds, per window)
+#   X-Rate-Limit-Ip-State: 1:10:0,1:60:0       (hits so far : period in seconds : active lockout in seconds)
+# and a 429 response comes with a Retry-After header. RateLimiter remembers all of that and makes requests wait
+# until they fit, instead of running into a lockout.
+import threading
+import time
+from collections import deque
+
+
+class Window:
+	"""
+	One rate limit window: at most hits requests in any period seconds.
+	"""
+	# Seconds a request is held in the window beyond its period. We count a request from when it's sent, the server
+	# from when it arrives, so without this the window frees up a little earlier for us than on the server.
+	SLACK = 0.25
+
+	def __init__(self, hits, period):
+		self.hits = hits
+		self.period = period
+		# When our requests in this window were sent, oldest first.
+		self.sent = deque()
+
+	def expire(self, now):
+		while self.sent and self.sent[0] <= now - self.period - self.SLACK:
+			self.sent.popleft()
+
+	def delay(self, now):
+		"""
+		Seconds until one more request fits in this window.
+		"""
+		self.expire(now)
+		if len(self.sent) < self.hits:
+			return 0
+
+		return self.sent[len(self.sent) - self.hits] + self.period + self.SLACK - now
+
+	def remaining(self, now):
+		self.expire(now)
+		return max(self.hits - len(self.sent), 0)
+
+
+class RateLimiter:
+	"""
+	Tracks the trade API's rate limit policies and holds requests back until they fit in them.
+
+	Requests are grouped by endpoint ("search", "fetch", ...) until a response tells us which policy the endpoint
+	belongs to. Endpoints that share a policy then share its budget. Until the first response of an endpoint is in,
+	nothing is known about its limits, so only one request to it is sent at a time.
+	"""
+	# Seconds between checks whether the first response of an endpoint came back, see acquire.
+	PROBE_INTERVAL = 0.05
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# endpoint -> policy name
+		self._policies = {}
+		# Endpoints that had a response, so their limits are known (or known to be missing).
+		self._known = set()
+		# endpoint -> requests sent whose response hasn't come back yet
+		self._in_flight = {}
+		# policy name -> {"<rule>:<period>": Window}
+		self._windows = {}
+		# policy name -> time we are locked out until
+		self._blocked_until = {}
+
+	def _policy(self, endpoint):
+		return self._policies.get(endpoint, endpoint)
+
+	def delay(self, endpoint, now=None):
+		"""
+		Seconds until a request to endpoint may be sent.
+		"""
+		now = time.monotonic() if now is None else now
+		with self._lock:
+			return self._delay(self._policy(endpoint), now)
+
+	def _delay(self, policy, now):
+		delay = self._blocked_until.get(policy, 0) - now
+		for window in self._windows.get(policy, {}).values():
+			delay = max(delay, window.delay(now))
+
+		return delay
+
+	def acquire(self, endpoint, cancel = None):
+		"""
+		Wait until a request to endpoint fits in its policy, and count it as sent. Every request acquired this way
+		has to be followed by update (or release, if it never got a response). If cancel (a threading.Event) is set
+		while waiting, give up.
+
+		returns the number of seconds waited, or None if cancelled.
+		"""
+		waited = 0
+		while True:
+			with self._lock:
+				if endpoint not in self._known and self._in_flight.get(endpoint):
+					# The first request is still out, wait for it to tell us the limits.
+					delay = self.PROBE_INTERVAL
+				else:
+					policy = self._policy(endpoint)
+					now = time.monotonic()
+					delay = self._delay(policy, now)
+					if delay <= 0:
+						for window in self._windows.get(policy, {}).values():
+							window.sent.append(now)
+						self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+						return waited
+
+			if cancel is None:
+				time.sleep(delay)
+			elif cancel.wait(delay):
+				return None
+			waited += delay
+
+	def release(self, endpoint):
+		"""
+		A request acquired for endpoint got no response (the connection failed, say).
+		"""
+		with self._lock:
+			self._release(endpoint)
+
+	def _release(self, endpoint):
+		if self._in_flight.get(endpoint):
+			self._in_flight[endpoint] -= 1
+
+	def update(self, endpoint, headers, status_code=200):
+		"""
+		Learn the policy of endpoint from the response to a request acquired for it, and bring our counts in line
+		with the server's.
+		"""
+		now = time.monotonic()
+		with self._lock:
+			self._known.add(endpoint)
+			self._release(endpoint)
+			policy = headers.get('X-Rate-Limit-Policy')
+			if policy:
+				self._policies[endpoint] = policy
+			else:
+				policy = self._policy(endpoint)
+
+			windows = self._windows.setdefault(policy, {})
+			# Requests on their way haven't reached the server yet, so they aren't in its counts.
+			pending = sum(count for (other, count) in self._in_flight.items() if self._policy(other) == policy)
+			rules = headers.get('X-Rate-Limit-Rules', '')
+			for rule in filter(None, (r.strip() for r in rules.split(','))):
+				limits = parse_rule(headers.get(f'X-Rate-Limit-{rule}', ''))
+				state = {period: (hits, active) for (hits, period, active) in
+						parse_rule(headers.get(f'X-Rate-Limit-{rule}-State', ''))}
+
+				for (hits, period, _) in limits:
+					window = windows.get(f'{rule}:{period}')
+					if window is None:
+						window = windows[f'{rule}:{period}'] = Window(hits, period)
+					window.hits = hits
+
+					(server_hits, active) = state.get(period, (0, 0))
+					# The server may have seen requests we didn't send (a browser on the same IP, say).
+					window.expire(now)
+					while len(window.sent) < server_hits + pending:
+						window.sent.append(now)
+
+					if active:
+						self._block(policy, now + active)
+
+			if status_code == 429:
+				retry_after = headers.get('Retry-After')
+				try:
+					retry_after = float(retry_after)
+				except (TypeError, ValueError):
+					retry_after = 60
+				self._block(policy, now + retry_after)
+
+	def _block(self, policy, until):
+		self._blocked_until[policy] = max(self._blocked_until.get(policy, 0), until)
+
+	def remaining(self):
+		"""
+		How many requests every known policy has left, per window.
+
+		returns dictionary {policy: {"<rule>:<period>": hits left}}
+		"""
+		now = time.monotonic()
+		with self._lock:
+			report = {}
+			for (policy, windows) in self._windows.items():
+				if self._blocked_until.get(policy, 0) > now:
+					report[policy] = {key: 0 for key in windows}
+				else:
+					report[policy] = {key: window.remaining(now) for (key, window) in windows.items()}
+
+			return report
+
+
+def parse_rule(value):
+	"""
+	Parse a rate limit header like "8:10:60,15:60:300".
+
+	returns list of tuples (int, int, int)
+	"""
+	rule = []
+	for part in value.split(','):
+		numbers = part.strip().split(':')
+		if len(numbers) != 3:
+			continue
+		try:
+			rule.append(tuple(int(n) for n in numbers))
+		except ValueError:
+			continue
+
+	return rule